@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       checkmodes.py
+#
+#       Check that the ways of running pypc which are meant to give the same
+#       outputs do give them. Each tree is preprocessed in comment mode and
+#       in export mode as the reference, then again with each option:
+#
+#           -j, --pipeline, --one-pass, --incremental (twice), --tree-cache
+#           (twice), --link, --block-map, --depends, --stats, --variant, -D
+#
+#       and the outputs must be the same files with the same bytes. The
+#       output of comment mode is then reversed (-r) as the reference, and
+#       again with --one-pass. The output of --block-map reversed with its
+#       block map must give the lines of the sources back. At last, what
+#       --affected prints for test/ is checked.
+#
+#       The trees are test/ (its files with the "//" mark, then test11 with
+#       "#", test12 and syntax_test/ have syntax errors on purpose) and a
+#       small tree made by gentree.py, with a file without tag lines and a
+#       binary file added.
+#
+#       python bench/checkmodes.py [-w workdir] [tree options]
+#
+#       The exit status is 1 when a check fails.
+#
+import os
+import sys
+import getopt
+import re
+import shutil
+import tempfile
+import subprocess
+
+_bench = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_bench, os.pardir))
+import pypc
+import gentree
+
+PYPC = os.path.join(_bench, os.pardir, "pypc.py")
+TEST = os.path.join(_bench, os.pardir, "test")
+
+# what a run keeps for itself in the destination dir
+_SIDECARS = (pypc.MANIFEST_NAME, pypc.DEPENDS_NAME, pypc.BLOCKMAP_NAME)
+
+# the small tree made by gentree.py
+TREE_DEFAULTS = {"files" : 30, "lines" : 200, "dirs" : 3}
+
+#############################################################
+#
+# Define the runs
+#
+#############################################################
+
+class Checker(object):
+
+    """Run pypc on the trees in workdir and count the failed checks"""
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.failed = []
+        self.count = 0
+
+    def run(self, name, args, expect=None):
+        '''
+        Run pypc with args, its output going to workdir/name.log.
+        Return the log, or None when pypc failed. With expect, a regular
+        expression, the log must have a line matching it.
+        '''
+        log = os.path.join(self.workdir, name + ".log")
+        f = open(log, "w")
+        try:
+            status = subprocess.call([sys.executable, PYPC] + args, stdout=f, stderr=subprocess.STDOUT)
+        finally:
+            f.close()
+        f = open(log, "r")
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        if status:
+            self.fail(name, "pypc exited with %d, see %s" % (status, log))
+            return None
+        if expect and not re.search(expect, text, re.M):
+            self.fail(name, "no line matching %r in %s" % (expect, log))
+            return None
+        return text
+
+    def same(self, name, expected, actual):
+        '''
+        Check that the dirs expected and actual have the same files with the
+        same content, the sidecar files of pypc left out.
+        '''
+        self.count += 1
+        left = _files(expected)
+        right = _files(actual)
+        diffs = sorted(set(left) ^ set(right))
+        for path in sorted(set(left) & set(right)):
+            if _read(left[path]) != _read(right[path]):
+                diffs.append(path)
+        if diffs:
+            self.fail(name, "%d file(s) differ from %s: %s" % (len(diffs), expected, " ".join(diffs[:5])))
+        else:
+            print "======>> ok %s" % name
+
+    def sources(self, name, srcdir, global_def, actual):
+        '''
+        Check that the dir actual, the output of comment mode reversed, has
+        the lines of srcdir and the global file back, but for the space put
+        after the comment mark and the value the #<< lines keep.
+        '''
+        self.count += 1
+        diffs = []
+        for path, fullpath in sorted(_files(actual).iteritems()):
+            source = os.path.join(srcdir, path)
+            if not os.path.exists(source) and path == os.path.basename(global_def):
+                source = global_def
+            if not os.path.exists(source):
+                diffs.append(path)
+                continue
+            expected = _read(source).splitlines(True)
+            lines = _read(fullpath).splitlines(True)
+            if len(expected) != len(lines):
+                diffs.append(path)
+                continue
+            for left, right in zip(expected, lines):
+                if left != right and right != " " + left and \
+                   not ("#<<" in left and right.startswith(left.rstrip("\r\n\t ") + " == ")):
+                    diffs.append(path)
+                    break
+        if diffs:
+            self.fail(name, "%d file(s) differ from the sources: %s" % (len(diffs), " ".join(diffs[:5])))
+        else:
+            print "======>> ok %s" % name
+
+    def equal(self, name, expected, actual):
+        self.count += 1
+        if expected != actual:
+            self.fail(name, "expected %r, got %r" % (expected, actual))
+        else:
+            print "======>> ok %s" % name
+
+    def fail(self, name, detail):
+        self.failed.append(name)
+        print "======>> FAILED %s: %s" % (name, detail)
+
+def _files(root):
+    '''
+    Return {path from root : full path} of the files in root.
+    '''
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename in _SIDECARS:
+                continue
+            fullpath = os.path.join(dirpath, filename)
+            files[os.path.relpath(fullpath, root)] = fullpath
+    return files
+
+def _read(path):
+    f = open(path, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _dirname(label):
+    return re.sub(r"\W+", "_", label).strip("_")
+
+def _first_global(global_def):
+    '''
+    Return (name, value) of the first #define global of global_def.
+    '''
+    m = re.search(r"#define\s+global\s+(\w+)\s+(.+?)\s*$", _read(global_def), re.M)
+    return m.group(1), m.group(2)
+
+def check_tree(checker, name, srcdir, global_def, comment):
+    '''
+    Run all the checks on the tree srcdir.
+    '''
+    out = os.path.join(checker.workdir, name)
+    base = ["-s", srcdir, "-i", global_def, "-m", comment]
+    key, value = _first_global(global_def)
+
+    for mode, flags in (("comment", []), ("export", ["-e"])):
+        prefix = "%s %s" % (name, mode)
+        reference = os.path.join(out, mode)
+        if checker.run("%s.%s" % (name, mode), base + flags + ["-d", reference]) is None:
+            continue
+
+        def check(label, args, runs=1, expect=None):
+            todir = os.path.join(out, "%s.%s" % (mode, _dirname(label)))
+            for i in range(runs):
+                if checker.run("%s.%s.%s.%d" % (name, mode, _dirname(label), i), base + flags + ["-d", todir] + args,
+                               expect if i else None) is None:
+                    return
+                checker.same("%s %s%s" % (prefix, label, " (run %d)" % (i + 1) if runs > 1 else ""),
+                             reference, todir)
+
+        check("-j 4", ["-j", "4"])
+        check("--pipeline 1", ["--pipeline", "1"])
+        check("--one-pass", ["--one-pass"])
+        check("--incremental", ["--incremental"], 2, "up to date")
+        check("--tree-cache", ["--tree-cache", os.path.join(out, "%s.cache" % mode)], 2,
+              r"^======>> cached\. src = .*%s" % re.escape(os.path.basename(global_def)))
+        check("--link", ["--link"])
+        check("--depends", ["--depends"])
+        check("--stats", ["--stats", os.path.join(out, "%s.stats.json" % mode)])
+        check("-D %s=%s" % (key, value), ["-D", "%s=%s" % (key, value)])
+        check("-j 4 --incremental", ["-j", "4", "--incremental"], 2, "up to date")
+        if mode == "comment":
+            check("--block-map", ["--block-map"])
+
+        variant = os.path.join(out, "%s.variant" % mode)
+        if checker.run("%s.%s.variant" % (name, mode),
+                       ["-s", srcdir, "-m", comment, "-d", variant, "--variant", "v=" + global_def] + flags) is not None:
+            checker.same("%s --variant" % prefix, reference, os.path.join(variant, "v"))
+
+    # reverse the output of comment mode, with and without the block map
+    reference = os.path.join(out, "reverse")
+    if checker.run("%s.reverse" % name, ["-r", "-s", os.path.join(out, "comment"), "-d", reference,
+                                         "-i", global_def, "-m", comment]) is None:
+        return
+    todir = os.path.join(out, "reverse.one_pass")
+    if checker.run("%s.reverse.one_pass" % name, ["-r", "-s", os.path.join(out, "comment"), "-d", todir,
+                                                  "-i", global_def, "-m", comment, "--one-pass"]) is not None:
+        checker.same("%s reverse --one-pass" % name, reference, todir)
+    # the block map gives the sources back, which the scan does not always
+    todir = os.path.join(out, "reverse.block_map")
+    if checker.run("%s.reverse.block_map" % name, ["-r", "-s", os.path.join(out, "comment.block_map"), "-d", todir,
+                                                   "-i", global_def, "-m", comment]) is not None:
+        checker.sources("%s reverse --block-map" % name, srcdir, global_def, todir)
+
+# what --affected prints for test/ with the graph of --depends: VALUE is
+# only read by test7 once it defined it, test2, test3 and test4 define their
+# own local VALUE, and test1 is included by test0 through test8 and test9
+TEST_AFFECTED = (
+    ("VALUE", []),
+    ("i_1", ["test10"]),
+    ("test3", ["test0", "test3"]),
+    ("test1", ["test0", "test1", "test8", "test9"]),
+)
+
+def check_affected(checker, name, srcdir, affected):
+    '''
+    Check what --affected prints with the graph the --depends run of the
+    tree name kept, for each (define or file of srcdir, expected outputs).
+    '''
+    todir = os.path.join(checker.workdir, name, "comment.depends")
+    for query, expected in affected:
+        if os.path.exists(os.path.join(srcdir, query)):
+            query = os.path.join(srcdir, query)
+        log = checker.run("%s.affected.%s" % (name, _dirname(os.path.basename(query))), ["-d", todir, "--affected", query])
+        if log is not None:
+            checker.equal("%s --affected %s" % (name, os.path.basename(query)), expected,
+                          sorted(os.path.relpath(line, todir) for line in log.split()))
+
+def make_trees(workdir, params):
+    '''
+    Make the trees to check in workdir, return [(name, srcdir, global file, comment)].
+    '''
+    trees = []
+    for name, comment, files in (("test", "//", ["test%d" % i for i in range(11)]),
+                                 ("test#", "#", ["test11"])):
+        srcdir = os.path.join(workdir, name, "src")
+        os.makedirs(srcdir)
+        for filename in files:
+            shutil.copy(os.path.join(TEST, filename), srcdir)
+        trees.append((name, srcdir, os.path.join(TEST, "global.def"), comment))
+
+    root = os.path.join(workdir, "gen")
+    tree_params = dict(TREE_DEFAULTS)
+    tree_params.update(params)
+    gentree.generate(root, **tree_params)
+    srcdir = os.path.join(root, "src")
+    f = open(os.path.join(srcdir, "plain.txt"), "wb")
+    try:
+        f.write("no tag line here\r\n# nor here\n")
+    finally:
+        f.close()
+    f = open(os.path.join(srcdir, "image.bin"), "wb")
+    try:
+        f.write("\x89PNG\r\n\x1a\n\0\0 // #ifdef X\n" * 10)
+    finally:
+        f.close()
+    trees.append(("gen", srcdir, os.path.join(root, "global.def"), tree_params.get("comment", "//")))
+    return trees
+
+def usage():
+    print '''
+    python checkmodes.py [-w workdir] [tree options]
+
+        -w  the dir the trees and the outputs are made in, a temporary dir
+            is used and removed by default
+        tree options are the ones of gentree.py for the generated tree:
+            --files N --lines N --density F --depth N --fanout N --dirs N --seed N
+    '''
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "w:h", gentree._LONG_OPTIONS)
+        params = gentree.parse_params(opts)
+        workdir = None
+        for o, a in opts:
+            if o == "-w":
+                workdir = a
+            elif o == "-h":
+                usage()
+                sys.exit()
+    except (getopt.GetoptError, ValueError), err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix="pypc_check")
+    elif os.path.exists(workdir):
+        shutil.rmtree(workdir)
+
+    checker = Checker(workdir)
+    try:
+        for name, srcdir, global_def, comment in make_trees(workdir, params):
+            check_tree(checker, name, srcdir, global_def, comment)
+            if name == "test":
+                check_affected(checker, name, srcdir, TEST_AFFECTED)
+    finally:
+        if temporary and not checker.failed:
+            shutil.rmtree(workdir, True)
+
+    print
+    if checker.failed:
+        print "======>> %d of %d check(s) failed, the outputs are in %s" % (len(checker.failed), checker.count, workdir)
+        sys.exit(1)
+    print "======>> %d check(s) passed" % checker.count
+
+if __name__ == "__main__":
+    main()
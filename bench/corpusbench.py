@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       corpusbench.py
+#
+#       End to end benchmark of pypc on a tree made by gentree.py. Each mode
+#       runs do_procedure in a child process:
+#
+#           comment     the default mode, the tree is preprocessed
+#           export      -e, the tree is exported
+#           reverse     -r, the output of the comment mode is reversed
+#
+#       and reports lines per second, files per second and the peak memory
+#       of the child (its workers included).
+#
+#       python bench/corpusbench.py [tree options] [-n repeat] [-j jobs] [--one-pass]
+#       python bench/corpusbench.py --sweep files=10,100,1000 [tree options]
+#       python bench/corpusbench.py ... -s FILE | -c FILE [-t 0.25]
+#
+#       The tree options are the ones of gentree.py. With --sweep, one
+#       dimension of the tree takes each of the values in turn. With -c, the
+#       exit status is 1 when a run is slower, or takes more memory, than the
+#       baseline by more than the tolerance. bench/corpus_baseline.json is the
+#       baseline of the current tree with the default options, the numbers
+#       depend on the machine.
+#
+import os
+import sys
+import getopt
+import time
+import json
+import shutil
+import tempfile
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import pypc
+import gentree
+
+MODES = ("comment", "export", "reverse")
+
+def _peak_memory():
+    '''
+    Return the peak resident size of this process and its children in MB,
+    or None where the resource module is missing.
+    '''
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":
+        # bytes on Mac OS, KB elsewhere
+        return peak / 1048576.0
+    return peak / 1024.0
+
+def _child(options, queue):
+    devnull = open(os.devnull, "w")
+    sys.stdout = devnull
+    try:
+        start = time.time()
+        pypc.do_procedure(options)
+        queue.put((time.time() - start, _peak_memory(), None))
+    except Exception, e:
+        queue.put((None, None, "%s: %s" % (e.__class__.__name__, e)))
+
+def _run(options):
+    '''
+    Run do_procedure in a child process, return (seconds, peak MB).
+    '''
+    if os.path.exists(options["todir"]):
+        shutil.rmtree(options["todir"])
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_child, args=(options, queue))
+    child.start()
+    elapsed, peak, error = queue.get()
+    child.join()
+    if error:
+        raise Exception, "%s failed in %s" % (options["srcdir"], error)
+    return elapsed, peak
+
+def bench(workdir, params, repeat=3, jobs=1, one_pass=False):
+    '''
+    Generate a tree with params in workdir and run every mode repeat times.
+    Return {mode : {"seconds", "lines_per_sec", "files_per_sec", "peak_mb"}},
+    the time is the best of the runs and the memory the largest.
+    '''
+    files, lines = gentree.generate(workdir, **params)
+    comment = params.get("comment", gentree.DEFAULTS["comment"])
+    srcdir = os.path.join(workdir, "src")
+    results = {}
+    for mode in MODES:
+        options = {
+                    "srcdir" : srcdir,
+                    "todir" : os.path.join(workdir, mode),
+                    "reverse" : mode == "reverse",
+                    "export" : mode == "export",
+                    "global" : os.path.join(workdir, "global.def"),
+                    "comment" : comment,
+                    "jobs" : jobs,
+                    "one_pass" : one_pass,
+                }
+        if mode == "reverse":
+            # what the comment mode made, without the copy of global.def
+            options["srcdir"] = os.path.join(workdir, "reversed_src")
+            if os.path.exists(options["srcdir"]):
+                shutil.rmtree(options["srcdir"])
+            shutil.copytree(os.path.join(workdir, "comment"), options["srcdir"],
+                            ignore=shutil.ignore_patterns("global.def"))
+
+        best = None
+        peak = None
+        for i in range(repeat):
+            elapsed, mb = _run(options)
+            best = elapsed if best is None else min(best, elapsed)
+            if mb is not None:
+                peak = mb if peak is None else max(peak, mb)
+        results[mode] = {
+                    "seconds" : round(best, 4),
+                    "lines_per_sec" : int(round(lines / best)),
+                    "files_per_sec" : round(files / best, 1),
+                    "peak_mb" : peak and round(peak, 1),
+                }
+    return results
+
+def _label(params):
+    return " ".join("%s=%s" % (key, params[key]) for key in sorted(params)) or "default"
+
+def compare(results, baseline, tolerance):
+    '''
+    Print each run against the baseline, return the runs out of the tolerance.
+    '''
+    worse = []
+    print
+    print "%-60s %12s %12s %8s %8s" % ("run", "base lines/s", "lines/s", "speed", "memory")
+    for name in sorted(results):
+        now = results[name]
+        if name not in baseline:
+            print "%-60s %12s %12d %8s %8s" % (name, "-", now["lines_per_sec"], "new", "")
+            continue
+        base = baseline[name]
+        speed = now["lines_per_sec"] / float(base["lines_per_sec"])
+        memory = None
+        if now["peak_mb"] and base["peak_mb"]:
+            memory = now["peak_mb"] / base["peak_mb"]
+        mark = ""
+        if speed < 1 / (1 + tolerance):
+            mark += "  SLOWER"
+        if memory and memory > 1 + tolerance:
+            mark += "  LARGER"
+        if mark:
+            worse.append(name)
+        print "%-60s %12d %12d %8.2f %8s%s" % (name, base["lines_per_sec"], now["lines_per_sec"], speed,
+                                               memory and "%.2f" % memory or "-", mark)
+    return worse
+
+def usage():
+    print '''
+    python corpusbench.py [tree options] [--sweep key=v1,v2,...] [-w workdir] [-n repeat] [-j jobs] [--one-pass]
+                          [-s baseline | -c baseline [-t tolerance]]
+
+        tree options are the ones of gentree.py:
+            --files N --lines N --density F --depth N --fanout N --dirs N --seed N -m comment
+        --sweep    run once for each value of a tree option, such as files=10,100,1000
+        -w         the dir the trees are made in, a temporary dir is used and removed by default
+        -n         runs of each mode, the best time is kept. The default is 3.
+        -j         number of worker processes of pypc. The default is 1.
+        --one-pass check the syntax while processing
+        -s         save the results to a baseline file
+        -c         compare the results with a baseline file, exit with 1 if a run is out of the tolerance
+        -t         the tolerance of -c, the default is 0.25
+    '''
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "m:w:n:j:s:c:t:h",
+                                       gentree._LONG_OPTIONS + ["sweep=", "one-pass"])
+        params = gentree.parse_params(opts)
+        workdir = None
+        repeat = 3
+        jobs = 1
+        one_pass = False
+        save = None
+        baseline = None
+        tolerance = 0.25
+        sweep = None
+        for o, a in opts:
+            if o == "-w":
+                workdir = a
+            elif o == "-n":
+                repeat = int(a)
+            elif o == "-j":
+                jobs = int(a)
+            elif o == "--one-pass":
+                one_pass = True
+            elif o == "-s":
+                save = a
+            elif o == "-c":
+                baseline = a
+            elif o == "-t":
+                tolerance = float(a)
+            elif o == "--sweep":
+                key, values = a.split("=", 1)
+                sweep = [gentree.parse_params([("--" + key, v)]) for v in values.split(",")]
+                if not all(sweep):
+                    raise ValueError, "unknown tree option %s" % key
+            elif o == "-h":
+                usage()
+                sys.exit()
+    except (getopt.GetoptError, ValueError), err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix="pypc_corpus")
+
+    results = {}
+    try:
+        print "%-60s %-8s %10s %12s %10s %8s" % ("run", "mode", "seconds", "lines/s", "files/s", "peak MB")
+        for extra in sweep or [{}]:
+            run_params = dict(params)
+            run_params.update(extra)
+            label = _label(run_params)
+            for mode, r in sorted(bench(workdir, run_params, repeat, jobs, one_pass).items()):
+                results["%s %s" % (label, mode)] = r
+                print "%-60s %-8s %10.3f %12d %10.1f %8s" % (label, mode, r["seconds"], r["lines_per_sec"],
+                                                             r["files_per_sec"], r["peak_mb"] or "-")
+    finally:
+        if temporary:
+            shutil.rmtree(workdir, True)
+
+    if save:
+        f = open(save, "w")
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        print "======>> baseline saved = %s" % save
+
+    if baseline:
+        f = open(baseline, "r")
+        try:
+            worse = compare(results, json.load(f), tolerance)
+        finally:
+            f.close()
+        if worse:
+            print "======>> %d run(s) out of the baseline by more than %d%%" % (len(worse), tolerance * 100)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
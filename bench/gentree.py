@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       gentree.py
+#
+#       Generate a synthetic source tree for pypc. The same parameters and
+#       seed always give the same tree.
+#
+#       python bench/gentree.py DIR [--files N] [--lines N] [--density F]
+#                                   [--depth N] [--fanout N] [--dirs N]
+#                                   [--seed N] [-m comment]
+#
+#       DIR/src is the source tree and DIR/global.def defines the global
+#       variables used by the conditions.
+#
+import os
+import sys
+import getopt
+import random
+import shutil
+
+DEFAULTS = {
+    "files" : 200,      # number of source files, the included ones are not counted
+    "lines" : 500,      # lines per file
+    "density" : 0.05,   # chance of a line to start a tag
+    "depth" : 2,        # the deepest #ifdef nesting
+    "fanout" : 2,       # #include per file
+    "dirs" : 10,        # number of sub dirs the files are spread over
+    "seed" : 1,
+    "comment" : "//",
+}
+
+# the global variables of global.def, by type
+_GLOBALS = {
+    "bool" : [("G_BOOL%d" % i, ("true", "false")[i % 2]) for i in range(4)],
+    "int" : [("G_INT%d" % i, str(i * 3)) for i in range(4)],
+    "float" : [("G_FLT%d" % i, "%d.5" % i) for i in range(2)],
+    "str" : [("G_STR%d" % i, '"value %d"' % i) for i in range(2)],
+}
+# the local variables defined at the top of every file
+_LOCALS = (("L_BOOL", "true"), ("L_INT", "5"))
+
+_WORDS = ("value", "count", "index", "result", "buffer", "left", "right", "node", "item", "total")
+
+class _Writer(object):
+
+    """Write the tag lines and the plain lines of one file"""
+
+    def __init__(self, rnd, params):
+        self.rnd = rnd
+        self.params = params
+        self.comment = params["comment"]
+        self.lines = []
+
+    def tag(self, text):
+        self.lines.append("%s %s\n" % (self.comment, text))
+
+    def plain(self):
+        rnd = self.rnd
+        words = [rnd.choice(_WORDS) for i in range(rnd.randint(2, 8))]
+        self.lines.append("%s%s = %s;\n" % ("    " * rnd.randint(0, 3), words[0], " + ".join(words[1:])))
+
+    def condition(self):
+        rnd = self.rnd
+        terms = []
+        for i in range(rnd.choice((1, 1, 1, 2, 3))):
+            kind = rnd.choice(("bool", "int", "float", "str", "local"))
+            if kind == "local":
+                terms.append(rnd.choice(("L_BOOL", "L_INT > 3")))
+            else:
+                name, value = rnd.choice(_GLOBALS[kind])
+                if kind == "bool":
+                    terms.append(rnd.choice((name, "%s == %s" % (name, value))))
+                elif kind == "str":
+                    terms.append("%s %s %s" % (name, rnd.choice(("==", "!=")), value))
+                else:
+                    terms.append("%s %s %s" % (name, rnd.choice(("==", "!=", "<", ">=")), value))
+        return rnd.choice((" or ", " and ")).join(terms)
+
+    def block(self, count, depth):
+        '''
+        Write count lines, the tags nested at most depth deep.
+        The #else branches are plain, so the commented output can be reversed.
+        '''
+        rnd = self.rnd
+        density = self.params["density"]
+        while count > 0:
+            if rnd.random() >= density:
+                self.plain()
+                count -= 1
+                continue
+
+            kind = rnd.random()
+            if kind < 0.6 and depth > 0 and count > 3:
+                inner = rnd.randint(1, min(count - 2, 20))
+                self.tag("#%s %s" % (rnd.choice(("ifdef", "ifdef", "ifndef")), self.condition()))
+                self.block(inner, depth - 1)
+                count -= inner + 2
+                if rnd.random() < 0.5 and count > 1:
+                    other = rnd.randint(1, min(count - 1, 10))
+                    self.tag("#else")
+                    for i in range(other):
+                        self.plain()
+                    count -= other + 1
+                self.tag("#endif")
+            elif kind < 0.8:
+                name, value = rnd.choice(_LOCALS)
+                self.tag("#define %s %s" % (name, value))
+                count -= 1
+            else:
+                kind = rnd.choice(sorted(_GLOBALS))
+                self.tag("#<< %s" % rnd.choice(_GLOBALS[kind])[0])
+                count -= 1
+
+def _genfile(rnd, params, includes):
+    w = _Writer(rnd, params)
+    for name, value in _LOCALS:
+        w.tag("#define %s %s" % (name, value))
+    for include in includes:
+        w.tag('#include "%s"' % include)
+    w.block(params["lines"] - len(w.lines), params["depth"])
+    return w.lines
+
+def generate(root, **kwargs):
+    '''
+    Generate root/src and root/global.def, return (number of files, number of lines).
+    The included files are at the top of root/src, the others spread over sub dirs.
+    '''
+    params = dict(DEFAULTS)
+    params.update(kwargs)
+    rnd = random.Random(params["seed"])
+
+    srcdir = os.path.join(root, "src")
+    if os.path.exists(srcdir):
+        shutil.rmtree(srcdir)
+    os.makedirs(srcdir)
+
+    total_files = 0
+    total_lines = 0
+
+    def write(path, lines):
+        f = open(path, "w")
+        try:
+            f.writelines(lines)
+        finally:
+            f.close()
+        return len(lines)
+
+    comment = params["comment"]
+    global_lines = []
+    for kind in sorted(_GLOBALS):
+        for name, value in _GLOBALS[kind]:
+            global_lines.append("%s #define global %s %s\n" % (comment, name, value))
+    write(os.path.join(root, "global.def"), global_lines)
+
+    # twice as many shared includes as each file uses, so the fan-in varies
+    headers = ["inc_%03d.h" % i for i in range(params["fanout"] * 2)]
+    for header in headers:
+        total_lines += write(os.path.join(srcdir, header), _genfile(rnd, params, ()))
+        total_files += 1
+
+    dirs = max(params["dirs"], 1)
+    for d in range(dirs):
+        os.mkdir(os.path.join(srcdir, "d%03d" % d))
+    for i in range(params["files"]):
+        path = os.path.join(srcdir, "d%03d" % (i % dirs), "f%05d.c" % i)
+        includes = rnd.sample(headers, params["fanout"])
+        total_lines += write(path, _genfile(rnd, params, includes))
+        total_files += 1
+
+    return total_files, total_lines
+
+_LONG_OPTIONS = ["files=", "lines=", "density=", "depth=", "fanout=", "dirs=", "seed="]
+
+def parse_params(opts):
+    '''
+    Return the generator parameters in opts, a list of (option, value).
+    '''
+    params = {}
+    for o, a in opts:
+        if o == "-m":
+            params["comment"] = a
+        elif o[2:] + "=" in _LONG_OPTIONS:
+            key = o[2:]
+            params[key] = type(DEFAULTS[key])(a)
+    return params
+
+def usage():
+    print '''
+    python gentree.py DIR [--files N] [--lines N] [--density F] [--depth N] [--fanout N] [--dirs N] [--seed N] [-m comment]
+
+        --files   number of source files, the default is %(files)s
+        --lines   lines per file, the default is %(lines)s
+        --density chance of a line to start a tag, the default is %(density)s
+        --depth   the deepest #ifdef nesting, the default is %(depth)s
+        --fanout  #include per file, the default is %(fanout)s
+        --dirs    number of sub dirs, the default is %(dirs)s
+        --seed    seed of the generator, the default is %(seed)s
+        -m        mark for comment, the default is "%(comment)s"
+    ''' % DEFAULTS
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "m:h", _LONG_OPTIONS)
+        if ("-h", "") in opts or len(args) != 1:
+            usage()
+            sys.exit(2)
+        params = parse_params(opts)
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(2)
+
+    files, lines = generate(args[0], **params)
+    print "======>> generated %d files, %d lines in %s" % (files, lines, args[0])
+
+if __name__ == "__main__":
+    main()
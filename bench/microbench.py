@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       microbench.py
+#
+#       Micro benchmarks for the pieces of pypc which run once per line or
+#       once per tag: the tag selector, the express selector and parsers,
+#       the define lookups, the tag processors of the lines out of a block,
+#       and the parsing and the rendering of a block tree, which processes
+#       the #ifdef blocks.
+#
+#       python bench/microbench.py                  print the numbers
+#       python bench/microbench.py -s FILE          save them as a baseline
+#       python bench/microbench.py -c FILE [-t 0.25] compare with a baseline
+#       python bench/microbench.py -k tag/          run the cases starting with tag/
+#
+#       bench/micro_baseline.json is the baseline of the current tree. The
+#       numbers depend on the machine, save a new one before comparing on
+#       another machine.
+#
+#       Each case is run in rounds of a fixed number of operations and the
+#       best round is kept, in microseconds per operation. With -c, the exit
+#       status is 1 when a case is slower than the baseline by more than the
+#       tolerance.
+#
+import os
+import sys
+import getopt
+import time
+import json
+import shutil
+import tempfile
+import cStringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import pypc
+
+#############################################################
+#
+# Define the cases
+#
+#############################################################
+
+# (name, function) in the order they run
+_cases = []
+
+def case(name):
+    def register(func):
+        _cases.append((name, func))
+        return func
+    return register
+
+def _make_context(export=True, comment="//", todir=None, srcdir=None):
+    cm = pypc.ContextManager()
+    cm.set_options({"export" : export, "comment" : comment, "srcdir" : srcdir, "todir" : todir})
+    _add_defines(cm)
+    return cm
+
+def _add_defines(cm):
+    cm.namespace_of_currentfile = "bench"
+    cm.addGlobalDefine("DEBUG", True)
+    cm.addGlobalDefine("LEVEL", 3)
+    cm.addGlobalDefine("RATIO", 1.5)
+    cm.addGlobalDefine("NAME", "pypc")
+    cm.addLocalDefine("LOCAL", 7)
+
+_tag_lines = (
+    # typical lines
+    ("plain", "    int value = compute(left, right); // a trailing comment\n"),
+    ("comment", "    // just a comment here\n"),
+    ("define", "// #define LOCAL 7\n"),
+    ("define_global", "// #define global LEVEL 3\n"),
+    ("ifdef", "// #ifdef DEBUG\n"),
+    ("ifdef_or", "// #ifdef LEVEL == 3 or NAME == \"pypc\" and RATIO > 1.0\n"),
+    ("ifndef", "    //#ifndef LEVEL >= 2\n"),
+    ("else", "// #else\n"),
+    ("endif", "// #endif\n"),
+    ("output", "// #<< LEVEL\n"),
+    ("output_global", "// #<< global LEVEL\n"),
+    ("include", "// #include \"lib/common.h\"\n"),
+    ("unknown", "// #pragma once\n"),
+    # pathological lines
+    ("long_plain", "x = y + 1; " * 400 + "\n"),
+    ("long_comment", "// " + "comment text " * 400 + "\n"),
+    ("long_head", "/" * 2000 + " #ifdef DEBUG\n"),
+    ("long_condition", "// #ifdef " + " or ".join(["K%d == %d" % (i, i) for i in range(200)]) + "\n"),
+    ("long_bad_define", "// #define K " + "1" * 2000 + "x\n"),
+)
+
+def _tag_case(line):
+    selector = pypc.TagSelector("//")
+    def run():
+        selector.getTagProcessor(line)
+    return run
+
+for _name, _line in _tag_lines:
+    case("tag/" + _name)(_tag_case(_line))
+
+# the search for the tag lines of a whole file
+_tag_files = (
+    ("typical", "".join("    line %d of the file;\n" % i for i in range(50)) + "// #ifdef DEBUG\n"),
+    ("long_comment_run", "/" * 20000 + "x #\n"),
+)
+
+def _find_case(data):
+    selector = pypc.TagSelector("//")
+    def run():
+        selector.findTagLine(data, 0)
+    return run
+
+for _name, _data in _tag_files:
+    case("tag/find/" + _name)(_find_case(_data))
+
+_express_samples = (
+    ("Boolean", "DEBUG == true"),
+    ("Integer", "LEVEL >= 2"),
+    ("Float", "RATIO < 2.5"),
+    ("String", "NAME == \"pypc\""),
+    ("Value", "LEVEL == global LEVEL"),
+    ("OnlyKey", "DEBUG"),
+)
+
+def _express_select_case(sample, cold):
+    cache = pypc.ExpressSelector._ExpressSelector__processor_cache
+    def run():
+        if cold:
+            cache.clear()
+        pypc.ExpressSelector.getExpressProcessor(sample)
+    return run
+
+def _express_eval_case(sample):
+    cm = _make_context()
+    parser = pypc.ExpressSelector.getExpressProcessor(sample)
+    def run():
+        parser.processExpress(sample, cm)
+    return run
+
+for _name, _sample in _express_samples:
+    case("express/select/" + _name)(_express_select_case(_sample, False))
+    case("express/select_cold/" + _name)(_express_select_case(_sample, True))
+    case("express/eval/" + _name)(_express_eval_case(_sample))
+
+def _define_case(key):
+    cm = _make_context()
+    def run():
+        try:
+            cm.getDefineValue(key)
+        except KeyError:
+            pass
+    return run
+
+case("context/getDefineValue/local")(_define_case("LOCAL"))
+case("context/getDefineValue/global")(_define_case("LEVEL"))
+case("context/getDefineValue/missing")(_define_case("MISSING"))
+
+# the body of the synthetic blocks
+_body = "".join("    line %d of the block;\n" % i for i in range(20))
+
+# the tag lines out of a block, each one processed by its processor
+_tags = (
+    ("DefineProcessor", "// #define LOCAL 7\n"),
+    ("DefineGlobalProcessor", "// #define global LEVEL 3\n"),
+    ("OutputProcessor", "// #<< LEVEL\n"),
+    ("OutputGlobalProcessor", "// #<< global NAME\n"),
+    ("UnknownProcessor", "// #pragma once\n"),
+    ("plain", _body),
+)
+
+# the blocks, which only a block tree processes
+_blocks = (
+    ("IfdefProcessor/true", "// #ifdef DEBUG\n" + _body + "// #endif\n"),
+    ("IfdefProcessor/false", "// #ifdef LEVEL > 5\n" + _body + "// #endif\n"),
+    ("IfndefProcessor", "// #ifndef DEBUG\n" + _body + "// #endif\n"),
+    ("ElseProcessor/taken", "// #ifdef LEVEL > 5\n" + _body + "// #else\n" + _body + "// #endif\n"),
+    ("ElseProcessor/skipped", "// #ifdef DEBUG\n" + _body + "// #else\n" + _body + "// #endif\n"),
+    ("IfdefProcessor/nested", "// #ifdef DEBUG\n" + ("// #ifdef LEVEL == 3\n" + _body + "// #else\n" + _body + "// #endif\n") * 3 + "// #endif\n"),
+)
+
+def _process(cm, data, dest):
+    it = pypc.FileIterator(data, cm.tag_selector)
+    while it.hasMore:
+        p = it.processor
+        if p:
+            p.process(it, dest, cm)
+        else:
+            it.writeRun(dest)
+
+def _block_case(data, export):
+    cm = _make_context(export)
+    def run():
+        _process(cm, data, cStringIO.StringIO())
+    return run
+
+for _name, _data in _tags:
+    case("processor/export/" + _name)(_block_case(_data, True))
+    case("processor/comment/" + _name)(_block_case(_data, False))
+
+def _tree_parse_case(data):
+    selector = pypc.TagSelector("//")
+    def run():
+        pypc.BlockTree.parse(data, pypc.SyntaxCheck("bench", selector), selector)
+    return run
+
+def _tree_render_case(data, export):
+    cm = _make_context(export)
+    tree = pypc.BlockTree.parse(data, pypc.SyntaxCheck("bench", cm.tag_selector), cm.tag_selector)
+    def run():
+        tree.render(data, cStringIO.StringIO(), cm)
+    return run
+
+for _name, _data in _tags + _blocks:
+    if _name == "UnknownProcessor":
+        # a syntax error, it has no tree
+        continue
+    case("tree/parse/" + _name)(_tree_parse_case(_data))
+    case("tree/render/export/" + _name)(_tree_render_case(_data, True))
+    case("tree/render/comment/" + _name)(_tree_render_case(_data, False))
+
+class _IncludeCase(object):
+
+    """IncludeProcessor processes the included file, so it needs a real tree"""
+
+    def __init__(self):
+        self.__dir = None
+
+    def __call__(self):
+        if self.__dir is None:
+            self.__dir = tempfile.mkdtemp(prefix="pypc_bench")
+            srcdir = os.path.join(self.__dir, "src")
+            os.makedirs(os.path.join(srcdir, "lib"))
+            os.makedirs(os.path.join(self.__dir, "out", "lib"))
+            f = open(os.path.join(srcdir, "lib", "common.h"), "w")
+            f.write("// #ifdef DEBUG\n" + _body + "// #endif\n")
+            f.close()
+            self.__cm = _make_context(True, srcdir=srcdir, todir=os.path.join(self.__dir, "out"))
+            self.__data = "// #include \"lib/common.h\"\n"
+        cm = self.__cm
+        cm.reset()
+        _add_defines(cm)
+        stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            _process(cm, self.__data, cStringIO.StringIO())
+        finally:
+            sys.stdout = stdout
+
+    def close(self):
+        if self.__dir:
+            shutil.rmtree(self.__dir, True)
+
+_include_case = _IncludeCase()
+case("processor/export/IncludeProcessor")(_include_case)
+
+#############################################################
+#
+# Define the runner
+#
+#############################################################
+
+def measure(func, min_time=0.05, rounds=5):
+    '''
+    Return the best time of one operation in microseconds.
+    The number of calls per round is grown until a round takes min_time.
+    '''
+    func()
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    best = elapsed
+    for r in xrange(rounds - 1):
+        start = time.time()
+        for i in xrange(number):
+            func()
+        best = min(best, time.time() - start)
+    return best * 1e6 / number
+
+def run(prefix="", min_time=0.05, rounds=5):
+    results = {}
+    try:
+        for name, func in _cases:
+            if name.startswith(prefix):
+                results[name] = measure(func, min_time, rounds)
+                print "%-50s %12.3f us" % (name, results[name])
+    finally:
+        _include_case.close()
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Print the ratio to the baseline of every case, return the slower cases.
+    '''
+    slower = []
+    print
+    print "%-50s %12s %12s %8s" % ("case", "baseline", "now", "ratio")
+    for name in sorted(results):
+        if name not in baseline:
+            print "%-50s %12s %12.3f %8s" % (name, "-", results[name], "new")
+            continue
+        ratio = results[name] / baseline[name]
+        mark = ""
+        if ratio > 1 + tolerance:
+            slower.append(name)
+            mark = "  SLOWER"
+        print "%-50s %12.3f %12.3f %8.2f%s" % (name, baseline[name], results[name], ratio, mark)
+    return slower
+
+def usage():
+    print '''
+    python microbench.py [-k prefix] [-s baseline | -c baseline [-t tolerance]] [-n seconds] [-r rounds]
+
+        -k Only run the cases whose name starts with prefix.
+        -s Save the numbers to a baseline file.
+        -c Compare the numbers with a baseline file, exit with 1 if a case is slower.
+        -t The tolerance of -c, 0.25 means 25% slower is still fine. The default is 0.25.
+        -n The minimal time of a round in seconds. The default is 0.05.
+        -r The number of rounds, the best one is kept. The default is 5.
+    '''
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "k:s:c:t:n:r:h")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    prefix = ""
+    save = None
+    baseline = None
+    tolerance = 0.25
+    min_time = 0.05
+    rounds = 5
+    try:
+        for o, a in opts:
+            if o == "-k":
+                prefix = a
+            elif o == "-s":
+                save = a
+            elif o == "-c":
+                baseline = a
+            elif o == "-t":
+                tolerance = float(a)
+            elif o == "-n":
+                min_time = float(a)
+            elif o == "-r":
+                rounds = int(a)
+            elif o == "-h":
+                usage()
+                sys.exit()
+    except ValueError:
+        usage()
+        sys.exit(2)
+
+    results = run(prefix, min_time, rounds)
+
+    if save:
+        f = open(save, "w")
+        try:
+            json.dump(dict((k, round(v, 3)) for k, v in results.iteritems()), f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        print "======>> baseline saved = %s" % save
+
+    if baseline:
+        f = open(baseline, "r")
+        try:
+            slower = compare(results, json.load(f), tolerance)
+        finally:
+            f.close()
+        if slower:
+            print "======>> %d case(s) slower than the baseline by more than %d%%" % (len(slower), tolerance * 100)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,35 @@ import getopt
 import sys
 from types import BooleanType,IntType,FloatType,StringType
 import cStringIO
+import cPickle
+import hashlib
+import mmap
+import time
+import threading
+import collections
+import codecs
+import fnmatch
+import stat
+# json and multiprocessing are slow to import and only some runs use
+# them, they are imported where they are used
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 #############################################################
 #
@@ -34,17 +63,15 @@ import cStringIO
 #
 #############################################################
 class ContextManager(object):
-    __instance = None
-    __already_init = False
-    def __new__(cls):
-        if not cls.__instance:
-            cls.__instance = super(ContextManager, cls).__new__(cls)
-        return cls.__instance
+
+    """
+    The defines, the done list and the options of one preprocessing job.
+    It is passed down to the tag processors and parsers, so many jobs
+    can run side by side.
+    """
 		
     def __init__(self):
-        if not self.__class__.__already_init:
-            self.__doInit()
-            self.__class__.__already_init = True
+        self.__doInit()
 	
     def __doInit(self):
         self.__global_define_dict = {}
@@ -52,24 +79,46 @@ class ContextManager(object):
         self.__done_list = []
         self.__backup_stack = []
         self.__namespace_of_currentfile = None
+        self.__records = []
+        self.__manifest = None
+        self.__stats = None
+        self.__depends = None
+        self.__block_map = None
+        self.__io_pipeline = None
+        self.__include_cache = IncludeCache()
+        self.__tree_cache = BlockTreeCache()
 	
     def set_options(self,options):
-        self.__srcdir = options["srcdir"]
-        self.__todir = options["todir"]
+        self.__srcdir = options.get("srcdir")
+        self.__todir = options.get("todir")
         self.__export = options.get("export",False)
         self.__comment = options.get("comment","#")
+        self.__tag_selector = TagSelector(self.__comment, options.get("binary_sniff", BINARY_SNIFF))
+        self.__one_pass = options.get("one_pass",False)
+        self.__jobs = options.get("jobs",1)
+        self.__pipeline = options.get("pipeline",0)
+        self.__link = options.get("link",False)
+        self.__path_filter = PathFilter(self.__srcdir, options.get("include"), options.get("exclude"))
+        self.__options = options
 		
-        if os.path.isdir(self.__srcdir):
+        if self.__srcdir is None:
+            # preprocess_lines, no file at all
+            self.__src_base_dir = None
+        elif os.path.isdir(self.__srcdir):
             self.__src_base_dir = self.__srcdir
         else:
             self.__src_base_dir = os.path.split(self.__srcdir)[0]
 			
-        if os.path.isdir(self.__todir):
+        if self.__todir is None:
+            self.__to_base_dir = None
+        elif os.path.isdir(self.__todir):
             self.__to_base_dir = self.__todir
         else:
             self.__to_base_dir = os.path.split(self.__todir)[0]
 	
     def getGlobalDefine(self, key):
+        if self.__records:
+            self.__recordRead(key)
         try:
             return self.__global_define_dict[key]
         except KeyError:
@@ -77,6 +126,25 @@ class ContextManager(object):
 		
     def addGlobalDefine(self, key, value):
         self.__global_define_dict[key] = value
+        for record in self.__records:
+            record.writes.append((key, value))
+            record.written.add(key)
+
+    def getGlobalSnapshot(self, key):
+        '''
+        Return (type, value) of a global define, or None if it is not defined.
+        '''
+        try:
+            value = self.__global_define_dict[key]
+        except KeyError:
+            return None
+        return (type(value), value)
+
+    def getGlobalDefines(self):
+        return self.__global_define_dict.copy()
+
+    def setGlobalDefines(self, defines):
+        self.__global_define_dict = defines.copy()
 	
     def getLocalDefine(self, key):
         try:
@@ -86,15 +154,42 @@ class ContextManager(object):
 		
     def addLocalDefine(self, key, value):
         self.__local_define_dict["%s.%s" % (self.__namespace_of_currentfile, key)] = value
+
+    def clearLocalDefines(self, namespace):
+        for key in self.__local_define_dict.keys():
+            if key.rsplit(".", 1)[0] == namespace:
+                del self.__local_define_dict[key]
 		
     def getDefineValue(self, key):
         try:
             return self.__local_define_dict["%s.%s" % (self.__namespace_of_currentfile, key)]
         except KeyError:
+            if self.__records:
+                self.__recordRead(key)
             try:
                 return self.__global_define_dict[key]
             except KeyError:
                 raise KeyError, 'Fail to find a value for %s' % (key)
+
+    def getDefineSnapshot(self, keys):
+        '''
+        Return the values of keys seen from the current file, keys is a list
+        of (key, whether it is read as global key). The local value of a key
+        read as key comes first, the global one is read when there is none.
+        The type is kept with the value, True and 1 are not the same define.
+        '''
+        snapshot = []
+        for key, is_global in keys:
+            if not is_global:
+                local_key = "%s.%s" % (self.__namespace_of_currentfile, key)
+                if local_key in self.__local_define_dict:
+                    value = self.__local_define_dict[local_key]
+                    snapshot.append((type(value), value))
+                    continue
+            if self.__records:
+                self.__recordRead(key)
+            snapshot.append(self.getGlobalSnapshot(key))
+        return tuple(snapshot)
 	
     def backupContext(self):
         if self.__namespace_of_currentfile:
@@ -106,6 +201,49 @@ class ContextManager(object):
 	
     def addFileToDone(self, file):
         self.__done_list.append(file)
+        for record in self.__records:
+            record.files.append(file)
+
+    def beginRecord(self):
+        '''
+        Record the global defines read and written, and the files done,
+        until endRecord. Records can be nested for #include.
+        '''
+        self.__records.append(DependencyRecord())
+
+    def endRecord(self):
+        return self.__records.pop()
+
+    def recordInclude(self, file):
+        if self.__records:
+            self.__records[-1].includes.append(file)
+
+    def recordOutput(self, file, tofile, output):
+        for record in self.__records:
+            record.outputs.append((file, tofile, output))
+
+    def replayRecord(self, reads, writes, files):
+        '''
+        Apply what the files of a record did, as if they were processed again.
+        '''
+        for key, value in reads.iteritems():
+            for record in self.__records:
+                if key not in record.reads and key not in record.written:
+                    record.reads[key] = value
+        for key, value in writes:
+            self.addGlobalDefine(key, value)
+        for file in files:
+            if not self.hasFileInDone(file):
+                self.__done_list.append(file)
+            for record in self.__records:
+                record.files.append(file)
+
+    def __recordRead(self, key):
+        value = self.getGlobalSnapshot(key)
+        for record in self.__records:
+            # the value read after the file defined it comes from the file itself
+            if key not in record.reads and key not in record.written:
+                record.reads[key] = value
 	
     def hasFileInDone(self, file):
         return file in self.__done_list
@@ -128,6 +266,58 @@ class ContextManager(object):
     @todir.setter
     def todir(self, value):
         self.__todir = value
+
+    @property
+    def manifest(self):
+        return self.__manifest
+
+    @manifest.setter
+    def manifest(self, value):
+        self.__manifest = value
+
+    @property
+    def depends(self):
+        return self.__depends
+
+    @depends.setter
+    def depends(self, value):
+        self.__depends = value
+
+    @property
+    def include_cache(self):
+        return self.__include_cache
+
+    @property
+    def tree_cache(self):
+        return self.__tree_cache
+
+    @tree_cache.setter
+    def tree_cache(self, value):
+        self.__tree_cache = value
+
+    @property
+    def block_map(self):
+        return self.__block_map
+
+    @block_map.setter
+    def block_map(self, value):
+        self.__block_map = value
+
+    @property
+    def io_pipeline(self):
+        return self.__io_pipeline
+
+    @io_pipeline.setter
+    def io_pipeline(self, value):
+        self.__io_pipeline = value
+
+    @property
+    def stats(self):
+        return self.__stats
+
+    @stats.setter
+    def stats(self, value):
+        self.__stats = value
 			
     @property
     def export(self):
@@ -136,6 +326,34 @@ class ContextManager(object):
     @property
     def comment(self):
         return self.__comment
+
+    @property
+    def tag_selector(self):
+        return self.__tag_selector
+
+    @property
+    def one_pass(self):
+        return self.__one_pass
+
+    @property
+    def jobs(self):
+        return self.__jobs
+
+    @property
+    def pipeline(self):
+        return self.__pipeline
+
+    @property
+    def link(self):
+        return self.__link
+
+    @property
+    def path_filter(self):
+        return self.__path_filter
+
+    @property
+    def options(self):
+        return self.__options
 		
     @property
     def namespace_of_currentfile(self):
@@ -147,32 +365,596 @@ class ContextManager(object):
 		
     def reset(self):
         self.__doInit() 
+
 		
     def printAllParam(self):
         print self.__param_dict
 
+class DependencyRecord(object):
+
+    """What a file depends on and changes, see ContextManager.beginRecord"""
+
+    __slots__ = ('reads', 'writes', 'written', 'files', 'includes', 'outputs')
+    def __init__(self):
+        self.reads = {}
+        self.writes = []
+        self.written = set()
+        self.files = []
+        # the files included by the file itself, done or not
+        self.includes = []
+        # (file, tofile, output) of the files written, output is None when
+        # it was not made here or is a mapped file, see _processsource
+        self.outputs = []
+
+#############################################################
+#
+# Define statistics of a run
+#
+#############################################################
+class Stats(object):
+
+    """
+    The numbers of a run, kept with --stats. Each file processed has an
+    entry, begin() and end() bracket it and current is the entry of the
+    innermost file. The time of a file leaves out the files it includes.
+    """
+
+    def __init__(self):
+        self.__start = time.time()
+        self.__files = []
+        self.__stack = []
+        self.__up_to_date = 0
+        self.__include_hits = 0
+        # condition -> [evaluated, cache hits]
+        self.__conditions = {}
+
+    @property
+    def current(self):
+        if self.__stack:
+            return self.__stack[-1][0]
+        return None
+
+    def begin(self, srcfile):
+        entry = {
+                    "src" : srcfile,
+                    "include_depth" : len(self.__stack),
+                    "bytes_read" : 0,
+                    "bytes_written" : 0,
+                    "lines" : 0,
+                    "tags" : {},
+                    "conditions" : 0,
+                    "condition_cache_hits" : 0,
+                    "check_seconds" : 0.0,
+                    "process_seconds" : 0.0,
+                    "unchanged" : False,
+                }
+        # entry, start time, time of the included files
+        self.__stack.append([entry, time.time(), 0.0])
+        return entry
+
+    def end(self):
+        entry, start, included = self.__stack.pop()
+        elapsed = time.time() - start
+        entry["process_seconds"] = max(elapsed - included - entry["check_seconds"], 0.0)
+        if self.__stack:
+            self.__stack[-1][2] += elapsed
+        self.__files.append(entry)
+
+    def countCondition(self, condition, hit):
+        entry = self.current
+        counts = self.__conditions.setdefault(condition, [0, 0])
+        counts[0] += 1
+        if entry:
+            entry["conditions"] += 1
+        if hit:
+            counts[1] += 1
+            if entry:
+                entry["condition_cache_hits"] += 1
+
+    def countUpToDate(self):
+        self.__up_to_date += 1
+
+    def countIncludeHit(self):
+        self.__include_hits += 1
+
+    def takeFiles(self):
+        """Return the entries of the files done and forget them"""
+        files = self.__files
+        self.__files = []
+        conditions = self.__conditions
+        self.__conditions = {}
+        return files, conditions
+
+    def addFiles(self, files, conditions):
+        """Add what takeFiles() of another Stats returned"""
+        self.__files.extend(files)
+        for condition, (evaluated, hits) in conditions.iteritems():
+            counts = self.__conditions.setdefault(condition, [0, 0])
+            counts[0] += evaluated
+            counts[1] += hits
+
+    def report(self):
+        totals = {
+                    "files" : len(self.__files),
+                    "up_to_date" : self.__up_to_date,
+                    "include_cache_hits" : self.__include_hits,
+                    "bytes_read" : 0,
+                    "bytes_written" : 0,
+                    "unchanged" : 0,
+                    "lines" : 0,
+                    "tags" : {},
+                    "conditions" : 0,
+                    "condition_cache_hits" : 0,
+                    "check_seconds" : 0.0,
+                    "process_seconds" : 0.0,
+                    "seconds" : time.time() - self.__start,
+                    "peak_rss_mb" : _peak_rss(),
+                }
+        for entry in self.__files:
+            for key in ("bytes_read", "bytes_written", "unchanged", "lines", "conditions", "condition_cache_hits",
+                        "check_seconds", "process_seconds"):
+                totals[key] += entry[key]
+            for tag, count in entry["tags"].iteritems():
+                totals["tags"][tag] = totals["tags"].get(tag, 0) + count
+
+        conditions = [{"condition" : c, "evaluated" : n[0], "cache_hits" : n[1]}
+                        for c, n in self.__conditions.iteritems()]
+        conditions.sort(key=lambda x: x["evaluated"] - x["cache_hits"], reverse=True)
+        files = sorted(self.__files, key=lambda x: x["check_seconds"] + x["process_seconds"], reverse=True)
+        return {"totals" : totals, "files" : files, "conditions" : conditions}
+
+    def save(self, path):
+        import json
+        f = open(path, "w")
+        try:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+#############################################################
+#
+# Define manifest for incremental build
+#
+#############################################################
+class Manifest(object):
+
+    """
+    Remember how each file was made: the source, the files it included,
+    the global defines it read and wrote, and the output.
+    A file can be skipped when all of them are still the same.
+    """
+
+    # 2: the #<< lines keep the line end of their file
+    __version = 2
+
+    def __init__(self, path, signature):
+        self.__path = path
+        self.__signature = signature
+        self.__entries = {}
+
+    def load(self):
+        try:
+            f = open(self.__path, "rb")
+            try:
+                version, signature, entries = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # no manifest yet, or a broken one, build everything
+            return
+        if version == self.__version and signature == self.__signature:
+            self.__entries = entries
+
+    def save(self):
+        f = open(self.__path, "wb")
+        try:
+            cPickle.dump((self.__version, self.__signature, self.__entries), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def getEntry(self, srcfile):
+        return self.__entries.get(srcfile)
+
+    def setEntry(self, srcfile, entry):
+        if entry:
+            self.__entries[srcfile] = entry
+
+    def removeEntry(self, srcfile):
+        self.__entries.pop(srcfile, None)
+
+    def record(self, srcfile, tofile, src_sig, output, record):
+        '''
+        Keep how srcfile made output. The signature of tofile is taken by
+        written(), once the output is on the disk.
+        '''
+        out_sig = (None, None, hashlib.md5(output).hexdigest())
+        includes = []
+        for file in record.files:
+            entry = self.__entries.get(file)
+            includes.append((file, entry and entry["src"][2]))
+        self.__entries[srcfile] = {
+                    "tofile" : tofile,
+                    "src" : src_sig,
+                    "out" : out_sig,
+                    "includes" : includes,
+                    "reads" : record.reads,
+                    "writes" : record.writes,
+                }
+
+    def written(self, srcfile):
+        entry = self.__entries.get(srcfile)
+        if entry:
+            entry["out"] = _filesig(entry["tofile"], entry["out"][2])
+
+    def reuse(self, cm, srcfile, tofile):
+        '''
+        Return True if tofile is still what srcfile makes, then apply
+        what the file did to the context as if it was processed.
+        '''
+        entry = self.__entries.get(srcfile)
+        if not entry or entry["tofile"] != tofile:
+            return False
+        if not self.__sameSource(srcfile, entry) or not self.__sameOutput(entry):
+            return False
+
+        for file, digest in entry["includes"]:
+            include_entry = self.__entries.get(file)
+            if not include_entry or include_entry["src"][2] != digest:
+                return False
+            if not self.__sameSource(file, include_entry) or not self.__sameOutput(include_entry):
+                return False
+        for key, value in entry["reads"].iteritems():
+            if cm.getGlobalSnapshot(key) != value:
+                return False
+
+        for key, value in entry["writes"]:
+            cm.addGlobalDefine(key, value)
+        cm.include_cache.reused(srcfile, entry["out"][2])
+        for file, digest in entry["includes"]:
+            cm.addFileToDone(file)
+            cm.include_cache.reused(file, self.__entries[file]["out"][2])
+        return True
+
+    def __sameSource(self, srcfile, entry):
+        size, mtime, digest = entry["src"]
+        try:
+            st = os.stat(srcfile)
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime) == (size, mtime):
+            return True
+        sig = _filesig(srcfile)
+        if sig[2] != digest:
+            return False
+        entry["src"] = sig
+        return True
+
+    def __sameOutput(self, entry):
+        tofile = entry["tofile"]
+        size, mtime, digest = entry["out"]
+        try:
+            st = os.stat(tofile)
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime) == (size, mtime):
+            return True
+        sig = _filesig(tofile)
+        if sig[2] != digest:
+            return False
+        entry["out"] = sig
+        return True
+
+#############################################################
+#
+# Define dependency graph
+#
+#############################################################
+class DependencyGraph(object):
+
+    """
+    The #include edges between the files, and the global defines each
+    file read and wrote, as they were when the files were processed.
+    It is kept as JSON so a build system can read it too, and answers
+    which outputs have to be made again when a file or a define changes.
+    """
+
+    __version = 1
+
+    def __init__(self, path):
+        self.__path = path
+        self.__entries = {}
+
+    def load(self):
+        import json
+        try:
+            f = open(self.__path, "r")
+            try:
+                graph = json.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # no graph yet, or a broken one
+            return False
+        if graph.get("version") != self.__version:
+            return False
+        self.__entries = graph["files"]
+        return True
+
+    def save(self):
+        import json
+        # forget the files which are gone
+        for srcfile in self.__entries.keys():
+            if not os.path.exists(srcfile):
+                del self.__entries[srcfile]
+        f = open(self.__path, "w")
+        try:
+            json.dump({"version" : self.__version, "files" : self.__entries}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    def getEntry(self, srcfile):
+        return self.__entries.get(os.path.realpath(srcfile))
+
+    def setEntry(self, srcfile, entry):
+        if entry:
+            self.__entries[os.path.realpath(srcfile)] = entry
+
+    def removeEntry(self, srcfile):
+        self.__entries.pop(os.path.realpath(srcfile), None)
+
+    def record(self, srcfile, tofile, record):
+        writes = []
+        for key, value in record.writes:
+            if key not in writes:
+                writes.append(key)
+        self.__entries[os.path.realpath(srcfile)] = {
+                    "tofile" : tofile,
+                    "includes" : sorted(set(os.path.realpath(f) for f in record.includes)),
+                    "reads" : sorted(record.reads),
+                    "writes" : sorted(writes),
+                }
+
+    def affected(self, files=(), defines=()):
+        '''
+        Return the sorted outputs to make again when files or defines change:
+        the ones of the files changed, the files reading the defines, the files
+        including them and the files reading what they define, over and over.
+        '''
+        includers = {}
+        readers = {}
+        for srcfile, entry in self.__entries.iteritems():
+            for include in entry["includes"]:
+                includers.setdefault(include, []).append(srcfile)
+            for key in entry["reads"]:
+                readers.setdefault(key, []).append(srcfile)
+
+        todo = [os.path.realpath(f) for f in files]
+        for key in defines:
+            todo.extend(readers.get(key, ()))
+        done = set()
+        while todo:
+            srcfile = todo.pop()
+            if srcfile in done:
+                continue
+            done.add(srcfile)
+            todo.extend(includers.get(srcfile, ()))
+            entry = self.__entries.get(srcfile)
+            if entry:
+                for key in entry["writes"]:
+                    todo.extend(readers.get(key, ()))
+        return sorted(self.__entries[f]["tofile"] for f in done if f in self.__entries)
+
+#############################################################
+#
+# Define include cache
+#
+#############################################################
+class IncludeCache(object):
+
+    """
+    What each #include of a file made, under the md5 of the file and the
+    global defines it read. An #include with the same key is served from
+    here, what the files did is applied to the context again.
+
+    A file has one output for the run: an #include under other defines is
+    processed again, for what it defines, but when it makes another output
+    than before, the first one is kept and a warning is printed, see
+    checkOutput. Which of the outputs won depended on the order of the
+    writes otherwise.
+    """
+
+    def __init__(self):
+        # srcfile -> [entry]
+        self.__entries = {}
+        # srcfile -> (size, mtime, md5)
+        self.__sigs = {}
+        # srcfile -> the md5 of the output it made in the run
+        self.__outputs = {}
+
+    def digest(self, srcfile):
+        st = os.stat(srcfile)
+        sig = self.__sigs.get(srcfile)
+        if not sig or sig[:2] != (st.st_size, st.st_mtime):
+            sig = self.__sigs[srcfile] = _filesig(srcfile)
+        return sig[2]
+
+    def lookup(self, cm, srcfile, tofile, digest):
+        for entry in self.__entries.get(srcfile, ()):
+            if entry["tofile"] != tofile or entry["digest"] != digest:
+                continue
+            for key, value in entry["reads"].iteritems():
+                if cm.getGlobalSnapshot(key) != value:
+                    break
+            else:
+                return entry
+        return None
+
+    def add(self, cm, srcfile, tofile, digest, record):
+        '''
+        Keep what processing srcfile recorded. The output files of the files
+        reused from the manifest are taken from there, a file with no output
+        is not kept.
+        '''
+        if srcfile not in record.files:
+            return
+        outputs = {}
+        for file, file_tofile, output in record.outputs:
+            outputs[file] = file_tofile
+        for file in record.files:
+            if file in outputs:
+                continue
+            manifest_entry = cm.manifest and cm.manifest.getEntry(file)
+            if not manifest_entry:
+                return
+            outputs[file] = manifest_entry["tofile"]
+        entry = {
+                    "tofile" : tofile,
+                    "digest" : digest,
+                    "reads" : record.reads,
+                    "writes" : record.writes,
+                    "files" : record.files,
+                    "outputs" : outputs,
+                }
+        self.__entries.setdefault(srcfile, []).append(entry)
+
+    def replay(self, cm, entry):
+        # the outputs are on the disk already, see checkOutput
+        for file, tofile in entry["outputs"].iteritems():
+            cm.recordOutput(file, tofile, None)
+        cm.replayRecord(entry["reads"], entry["writes"], entry["files"])
+
+    def checkOutput(self, srcfile, output):
+        '''
+        Keep the md5 of output, what srcfile makes now, and return True.
+        Return False when it made another output earlier in the run, under
+        the defines of another #include or of the walk, which is kept.
+        '''
+        digest = hashlib.md5(output).hexdigest()
+        return self.__outputs.setdefault(srcfile, digest) == digest
+
+    def reused(self, file, digest):
+        '''
+        Keep digest, the md5 of the output file has from the last run.
+        '''
+        self.__outputs[file] = digest
+
 ############################################################
 #
 # Define kit functions
 #
 ############################################################
 
-_compile_integer = re.compile(r"[+-]?\d+")
+class _LazyRegex(object):
+
+    """
+    A regular expression compiled on its first use, so a run only compiles
+    the ones it needs. Then its match and search are the compiled ones.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError, name
+        regex = re.compile(self.pattern)
+        self.match = regex.match
+        self.search = regex.search
+        return getattr(regex, name)
+
+    def __repr__(self):
+        return "_LazyRegex(%r)" % self.pattern
+
+_compile_integer = _LazyRegex(r"[+-]?\d+")
 def isInteger(value):
     return _compile_integer.match(value)	
 	
-_compile_float = re.compile(r"[+-]?\d+(\.\d+)?")
+_compile_float = _LazyRegex(r"[+-]?\d+(\.\d+)?")
 def isFloat(value):
     return _compile_float.match(value)
 
-_compile_string = re.compile(r'^\".+\"$')
+_compile_string = _LazyRegex(r'^\".+\"$')
 def isString(value):
     return _compile_string.match(value)
 	
-_compile_bool = re.compile(r"((true)|(True)|(TRUE)|(false)|(False)|(FALSE)){1}")
+_compile_bool = _LazyRegex(r"((true)|(True)|(TRUE)|(false)|(False)|(FALSE)){1}")
 def isBool(value):
     return _compile_bool.match(value)
 
+def _filesig(path, digest=None):
+    '''
+    Return (size, mtime, md5) of a file. The md5 is computed when not given.
+    '''
+    if digest is None:
+        md5 = hashlib.md5()
+        f = open(path, "rb")
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                md5.update(data)
+        finally:
+            f.close()
+        digest = md5.hexdigest()
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, digest)
+
+def _peak_rss():
+    '''
+    Return the peak resident size of the process and its workers in MB,
+    or None without the resource module.
+    '''
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":
+        # bytes on Mac OS, KB elsewhere
+        return peak / 1048576.0
+    return peak / 1024.0
+
+# the bytes of a file looked at for a NUL, to tell a binary file
+BINARY_SNIFF = 8000
+
+# the files from this size on are mapped instead of read
+_mmap_threshold = 1 << 20
+def _readsource(path):
+    '''
+    Return the content of a source file as a string, or as a read only
+    mmap for a large one. The caller closes the mmap.
+    The file is read as bytes, its encoding and line ends are kept as
+    they are.
+    '''
+    f = open(path, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size < _mmap_threshold:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def _closesource(data):
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+# the bytes of a mapped file taken at a time
+_copy_chunk = 1 << 16
+def _chunks(data):
+    '''
+    Yield data by chunks, so a mapped file is never copied whole in memory.
+    '''
+    for pos in xrange(0, len(data), _copy_chunk):
+        yield data[pos:pos + _copy_chunk]
+
+def _countlines(data):
+    if isinstance(data, str):
+        count = data.count("\n")
+    else:
+        count = sum(chunk.count("\n") for chunk in _chunks(data))
+    return count + (data[-1:] not in ("", "\n"))
+
 ############################################################
 #
 # Define a base class for Parser
@@ -182,16 +964,16 @@ def isBool(value):
 class Parser(object):
     """A base class for all express parsers"""
 	
-    def processExpress(self,express):
-        express_tuple = self.parseExpress(express)
+    def processExpress(self, express, cm):
+        express_tuple = self.parseExpress(express, cm)
         if express_tuple:
-            return self.checkExpress(express_tuple)
+            return self.checkExpress(express_tuple, cm)
         return False
 	
-    def parseExpress(self, express):
+    def parseExpress(self, express, cm):
         return None
 	
-    def checkExpress(self, express):
+    def checkExpress(self, express, cm):
         return False
 
 #############################################################
@@ -203,7 +985,7 @@ class Parser(object):
 class DefineGlobalBooleanParser(Parser):
     """# #define global BOOL TRUE"""
 	
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
 		
         express_list = statement[statement.find("global") + 6:].strip().split()
         if len(express_list) == 2:
@@ -222,7 +1004,7 @@ class DefineGlobalBooleanParser(Parser):
 class DefineGlobalIntegerParser(Parser):
     """# #define global INT 123"""
 
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
 		
         express_list = statement[statement.find("global") + 6:].strip().split()
         if len(express_list) == 2:
@@ -239,7 +1021,7 @@ class DefineGlobalIntegerParser(Parser):
 class DefineGlobalFloatParser(Parser):
     """# #define global FLOAT 123"""
 
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
 		
         express_list = statement[statement.find("global") + 6:].strip().split()
         if len(express_list) == 2:
@@ -256,7 +1038,7 @@ class DefineGlobalFloatParser(Parser):
 class DefineGlobalStringParser(Parser):
     """# #define global str "I am a string" """
 
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
         
         express_list = statement[statement.find("global") + 6:].strip().split(None, 1)
         if len(express_list) == 2:
@@ -267,7 +1049,7 @@ class DefineGlobalStringParser(Parser):
 class DefineBooleanParser(Parser):
     """# #define BOOL TRUE"""
     
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
 		
         express_list = statement[statement.find("#define") + 7:].strip().split()
         if len(express_list) == 2:
@@ -286,7 +1068,7 @@ class DefineBooleanParser(Parser):
 class DefineIntegerParser(Parser):
     """# #define INT 123"""
     
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
 		
         express_list = statement[statement.find("#define") + 7:].strip().split()
         if len(express_list) == 2:
@@ -303,7 +1085,7 @@ class DefineIntegerParser(Parser):
 class DefineFloatParser(Parser):
     """# #define FLOAT 123"""
     
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
 		
         express_list = statement[statement.find("#define") + 7:].strip().split()
         if len(express_list) == 2:
@@ -320,7 +1102,7 @@ class DefineFloatParser(Parser):
 class DefineStringParser(Parser):
     '''# #define str "I am a string"'''
     
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
 		
         express_list = statement[statement.find("#define") + 7:].strip().split(None,1)
         if len(express_list) == 2:
@@ -335,7 +1117,7 @@ class ValueParser(Parser):
 	 global v1 == global v2
     '''	
 	
-    def parseExpress(self, statement):
+    def parseExpress(self, statement, cm):
         """
 		it is deffierent with other parser
 		the return is to replace right variable with its value
@@ -345,19 +1127,19 @@ class ValueParser(Parser):
         if express_length == 3:
             """ value1 == value2 """
             left = express_list[2]
-            value = ContextManager().getDefineValue(left)
+            value = cm.getDefineValue(left)
             express_list[2] = value
 		
         elif express_length == 4:
             """global value1 == value"""
             left = express_list[3]
-            value = ContextManager().getDefineValue(left)
+            value = cm.getDefineValue(left)
             express_list[3] = value
 		
         elif express_length == 5:
             """ global value1 == global value"""
             left = express_list[4]
-            value = ContextManager().getGlobalDefine(left)
+            value = cm.getGlobalDefine(left)
             express_list[3] = ""
             express_list[4] = value
 		
@@ -366,20 +1148,20 @@ class ValueParser(Parser):
 			
         return express_list
 	
-    def checkExpress(self, express):
+    def checkExpress(self, express, cm):
 		
         right_value = express[-1]
         right_type = type(right_value)
 		
         express = " ".join(map(lambda x:str(x),express))
         if right_type is BooleanType:
-            return BooleanParser().processExpress(express)
+            return BooleanParser().processExpress(express, cm)
         elif right_type is IntType:
-            return IntegerParser().processExpress(express)
+            return IntegerParser().processExpress(express, cm)
         elif right_type is FloatType:
-            return FloatParser().processExpress(express)
+            return FloatParser().processExpress(express, cm)
         elif right_type is StringType:
-            return StringParser().processExpress(express)
+            return StringParser().processExpress(express, cm)
         else:
             return False
 				
@@ -389,7 +1171,7 @@ class BooleanParser(Parser):
 	global key == false
     """
 	
-    def parseExpress(self, express):
+    def parseExpress(self, express, cm):
 
         express_list = express.split()
         if express.startswith("global") and len(express_list) == 4:
@@ -397,11 +1179,11 @@ class BooleanParser(Parser):
             express_list = express_list[1:]
             """now, key == fals"""
             key = express_list[0]
-            value = ContextManager().getGlobalDefine(key)
+            value = cm.getGlobalDefine(key)
 		
         elif len(express_list) == 3:
             key = express_list[0]
-            value = ContextManager().getDefineValue(key)
+            value = cm.getDefineValue(key)
 		
         else:
             return None
@@ -421,7 +1203,7 @@ class BooleanParser(Parser):
 				
         return tuple(express_list)
 		
-    def checkExpress(self, express):
+    def checkExpress(self, express, cm):
 
         if express[1] == "==":
             return express[0] == express[2]
@@ -436,7 +1218,7 @@ class FloatParser(BooleanParser):
 	float = 99.99
     '''		
 		
-    def parseExpress(self, express):
+    def parseExpress(self, express, cm):
 		
         express_list = express.split()
         if express.startswith("global") and len(express_list) == 4:
@@ -444,11 +1226,11 @@ class FloatParser(BooleanParser):
             express_list = express_list[1:]
             """now, float == 99.9"""
             key = express_list[0]
-            value = ContextManager().getGlobalDefine(key)
+            value = cm.getGlobalDefine(key)
 			
         elif len(express_list) == 3:
             key = express_list[0]
-            value = ContextManager().getDefineValue(key)
+            value = cm.getDefineValue(key)
 		
         else:
             return None
@@ -463,7 +1245,7 @@ class FloatParser(BooleanParser):
         return tuple(express_list)
 		
 			
-    def checkExpress(self, express):
+    def checkExpress(self, express, cm):
 
         left = express[0]
         compare = express[1]
@@ -488,7 +1270,7 @@ class IntegerParser(FloatParser):
 	global int == 10
 	int == 10   
     '''
-    def parseExpress(self, express):
+    def parseExpress(self, express, cm):
 
         express_list = express.split()
         if express.startswith("global") and len(express_list) == 4:
@@ -496,11 +1278,11 @@ class IntegerParser(FloatParser):
             express_list = express_list[1:]
             """now, int == 10"""
             key = express_list[0]
-            value = ContextManager().getGlobalDefine(key)
+            value = cm.getGlobalDefine(key)
 			
         elif len(express_list) == 3:
             key = express_list[0]
-            value = ContextManager().getDefineValue(key)
+            value = cm.getDefineValue(key)
 		
         else:
             return None
@@ -519,7 +1301,7 @@ class OnlyKeyParser(Parser):
 	global key
 	key
     '''	
-    def parseExpress(self, express):
+    def parseExpress(self, express, cm):
 
         express_list = express.split()
         try:
@@ -528,11 +1310,11 @@ class OnlyKeyParser(Parser):
                 express_list = express_list[1:]
                 """now,pypc_doc key"""
                 key = express_list[0]
-                value = ContextManager().getGlobalDefine(key)
+                value = cm.getGlobalDefine(key)
 				
             elif len(express_list) == 1:
                 key = express_list[0]
-                value = ContextManager().getDefineValue(key)
+                value = cm.getDefineValue(key)
             else:
                 return None
 
@@ -542,7 +1324,7 @@ class OnlyKeyParser(Parser):
         except KeyError:
             return None
 
-    def checkExpress(self, express):
+    def checkExpress(self, express, cm):
 
         try:
             value = express[0]
@@ -558,7 +1340,7 @@ class StringParser(Parser):
 	global str == "a string here"
 	str == "a string here"
     '''	
-    def parseExpress(self, express):
+    def parseExpress(self, express, cm):
 		
         if express.startswith("global"):
             express_list = express.split(None,3)
@@ -570,11 +1352,11 @@ class StringParser(Parser):
             express_list = express_list[1:]
             ''' now, str == "a string" '''
             key = express_list[0]
-            value = ContextManager().getGlobalDefine(key)
+            value = cm.getGlobalDefine(key)
 			
         elif len(express_list) == 3:
             key = express_list[0]
-            value = ContextManager().getDefineValue(key)
+            value = cm.getDefineValue(key)
         else:
             return None
 			
@@ -587,7 +1369,7 @@ class StringParser(Parser):
         express_list[2] = express_list[2].strip('"\r\n\t ')
         return tuple(express_list)
 
-    def checkExpress(self, express):
+    def checkExpress(self, express, cm):
 
         left = express[0]
         compare = express[1]
@@ -639,12 +1421,56 @@ class StringParser(Parser):
 #############################################################
 class FileIterator(object):
 	
-    __slots__ = ('hasMore', 'next', '__file', '__next')
-    def __init__(self, file):
-        self.__file = file
+    """
+    Iterate the lines of file, a file like object or the whole content
+    as a string or a mmap. With the whole content, writeRun copies the
+    runs of plain lines with one write.
+    """
+    __slots__ = ('hasMore', 'next', 'processor', '__file', '__data', '__pos', '__next', '__processor',
+                 '__run_end', '__run_processor', '__tag_selector', '__checker', '__stats')
+    def __init__(self, file, tag_selector, checker=None, stats=None):
+        if isinstance(file, (str, mmap.mmap)):
+            self.__file = None
+            self.__data = file
+        else:
+            self.__file = file
+            self.__data = None
+        self.__pos = 0
+        self.__run_end = -1
+        self.__run_processor = None
+        self.__tag_selector = tag_selector
+        self.__checker = checker
+        # the Stats entry of the file, which counts the lines and the tags
+        self.__stats = stats
 		
     def __getHasMore(self):
-        self.__next = self.__file.readline()
+        data = self.__data
+        if data is None:
+            self.__next = self.__file.readline()
+            self.__processor = False
+        else:
+            pos = self.__pos
+            end = data.find("\n", pos) + 1 or len(data)
+            self.__next = data[pos:end]
+            self.__pos = end
+            if pos == self.__run_end:
+                self.__processor = self.__run_processor
+                if self.__stats and self.__processor:
+                    self.__countTag(self.__processor)
+            else:
+                self.__processor = False
+        if self.__stats and self.__next:
+            self.__stats["lines"] += 1
+        if self.__checker:
+            try:
+                if self.__next:
+                    self.__checker.checkLine(self.__next, self.processor)
+                else:
+                    self.__checker.checkEnd()
+                    self.__checker = None
+            except SyntaxError:
+                self.__checker = None
+                raise
         if self.__next:
             return True
         else:
@@ -660,6 +1486,78 @@ class FileIterator(object):
     
     next = property(__getNext)
 
+    def __getProcessor(self):
+        if self.__processor is False:
+            self.__processor = self.__tag_selector.getTagProcessor(self.__next)
+            if self.__stats and self.__processor:
+                self.__countTag(self.__processor)
+        return self.__processor
+
+    def __countTag(self, p):
+        tags = self.__stats["tags"]
+        name = type(p).__name__
+        tags[name] = tags.get(name, 0) + 1
+
+    processor = property(__getProcessor)
+
+    def writeRun(self, dest):
+        """
+        Write the current line, which must be a plain one, and the plain
+        lines after it to dest in one write. With dest None they are skipped.
+        The next hasMore reads the first tag line after them.
+        """
+        data = self.__data
+        if data is None:
+            if dest:
+                dest.write(self.__next)
+            return
+
+        pos = self.__pos
+        end, self.__run_processor = self.__tag_selector.findTagLine(data, pos)
+        self.__run_end = end
+        if dest:
+            dest.write(data[pos - len(self.__next):end])
+        if end > pos and (self.__checker or self.__stats):
+            # a mmap has no count()
+            run = data[pos:end]
+            count = run.count("\n")
+            if run[-1] != "\n":
+                count += 1
+            if self.__checker:
+                self.__checker.skipLines(count)
+            if self.__stats:
+                self.__stats["lines"] += count
+        self.__pos = end
+
+    def runSpan(self):
+        """
+        Skip the run of plain lines as writeRun(None) does, and return
+        (start, end) of the run in the whole content.
+        """
+        start = self.__pos - len(self.__next)
+        self.writeRun(None)
+        return start, self.__pos
+
+class LineReader(object):
+	
+    """A src for FileIterator which reads from an iterable of lines"""
+    __slots__ = ('__lines',)
+    def __init__(self, lines):
+        self.__lines = iter(lines)
+
+    def readline(self):
+        return next(self.__lines, "")
+
+class LineWriter(object):
+	
+    """A dest for the tag processors which keeps the written lines"""
+    __slots__ = ('lines',)
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
 #############################################################
 #
 # Define a base class for Tag Processor
@@ -677,18 +1575,18 @@ class TagProcessor(object):
             else:
                 raise TypeError, "[ %s ] must be a Parser Type" % (parser)
 	
-    def process(self, src, dest):
+    def process(self, src, dest, cm):
 		
-        if ContextManager().export:
-            self.doExportProcess(src, dest)
+        if cm.export:
+            self.doExportProcess(src, dest, cm)
         else:
-            self.doNonExportProcess(src, dest)
+            self.doNonExportProcess(src, dest, cm)
 
-    def doNonExportProcess(self, src, dest):
+    def doNonExportProcess(self, src, dest, cm):
         dest.write(src.next)
-        self.doExportProcess(src, dest)
+        self.doExportProcess(src, dest, cm)
 		
-    def doExportProcess(self, src, dest):
+    def doExportProcess(self, src, dest, cm):
         pass
 #############################################################
 #
@@ -698,68 +1596,20 @@ class TagProcessor(object):
 
 class DefineGlobalProcessor(TagProcessor):
 	
-    def doExportProcess(self, src, dest):
+    def doExportProcess(self, src, dest, cm):
         if self._parser:
-            key_value = self._parser.parseExpress(src.next)
-            ContextManager().addGlobalDefine(key_value[0], key_value[1])
+            key_value = self._parser.parseExpress(src.next, cm)
+            cm.addGlobalDefine(key_value[0], key_value[1])
 
 class DefineProcessor(TagProcessor):
 	
-    def doExportProcess(self, src, dest):
+    def doExportProcess(self, src, dest, cm):
         if self._parser:
-            key_value = self._parser.parseExpress(src.next)
-            ContextManager().addLocalDefine(key_value[0], key_value[1])
+            key_value = self._parser.parseExpress(src.next, cm)
+            cm.addLocalDefine(key_value[0], key_value[1])
 
 class ElseProcessor(TagProcessor):
-	
-    def doExportProcess(self, src, dest):
-        while src.hasMore:
-            line = src.next
-            p = TagSelector.getTagProcessor(src.next)
-            if p:
-                if isinstance(p, EndifProcessor):
-                    p.process(src, dest)
-                    return
-                else:
-                    p.process(src, dest)
-            else:
-                dest.write(line)
-
-class NotNeedElseProcessor(TagProcessor):
-	
-    def doNonExportProcess(self, src, dest):
-		
-        comment = ContextManager().comment
-        dest.write(src.next)
-        count_if = 1
-        while src.hasMore:
-            line = src.next
-            p = TagSelector.getTagProcessor(line)
-            if p:
-                if isinstance(p, IfdefProcessor) or isinstance(p, IfndefProcessor):
-                    count_if += 1
-                elif isinstance(p, EndifProcessor):
-                    count_if -= 1
-                    p.process(src, dest)
-                    if count_if == 0:
-                        return
-
-            dest.write("%s %s" % (comment, line))
-
-    def doExportProcess(self, src, dest):
-	
-        count_if = 1
-        while src.hasMore:
-            line = src.next
-            p = TagSelector.getTagProcessor(line)
-            if p:
-                if isinstance(p, IfdefProcessor) or isinstance(p, IfndefProcessor):
-                    count_if += 1
-                elif isinstance(p, EndifProcessor):
-                    count_if -= 1
-                    p.process(src, dest)
-                    if count_if == 0:
-                        return
+    pass
 
 class EndifProcessor(TagProcessor):
     pass
@@ -767,153 +1617,79 @@ class EndifProcessor(TagProcessor):
 class IfdefProcessor(TagProcessor):
     '''
 	# #ifdef key == value
+    The blocks are processed by BlockTree, which takes their condition here.
     '''
+    negate = False
+
     def __init__(self):
         self._tag = "#ifdef"
         self._tag_length = len(self._tag)
+            
+class IfndefProcessor(IfdefProcessor):
 	
-    def getExpressResult(self,src):
-        line = src.next
-        or_express_list = line[ line.find(self._tag) + self._tag_length: ].strip().split(" or ")
-        or_result = False
-        for and_express in or_express_list:
-            and_express_list = and_express.split(" and ")
-            and_result = True
-            for express in and_express_list:
-                express = express.strip("\r\n\t ")
-                parser = ExpressSelector.getExpressProcessor(express)
-                if parser:
-                    result = parser.processExpress(express)
-                    if not result:
-                        and_result = False
-                        break # jump out and loop
-                else:
-                    raise SyntaxError, " %s is a illegale express" % express
-            if and_result:
-                or_result = True
-                break # jump out or loop
-		
-        #print "or_result = %s" % or_result
-        return or_result
-		
-    def doExportProcess(self, src, dest):
+    negate = True
 
-        result = self.getExpressResult(src)
-        if result:
-            self.recordIfBlockOnly(src, dest)
-        else:
-            self.recordElseBlockOnly(src, dest)
-				
-    def recordIfBlockOnly(self, src, dest):
-        
-        while src.hasMore:
-            line = src.next
-            p = TagSelector.getTagProcessor(line)
-            if p:
-                if isinstance(p, EndifProcessor):
-                    p.process(src, dest)
-                    return
-                elif isinstance(p, ElseProcessor):
-                    NotNeedElseProcessor().process(src, dest)
-                    return
-                else:
-                    p.process(src, dest)
-            else:
-                dest.write(line)
-	
-    def recordElseBlockOnly(self, src, dest):
-        
-        export = ContextManager().export
-        comment = ContextManager().comment
-        count_if = 1
-
-        while src.hasMore:
-            line = src.next
-            p = TagSelector.getTagProcessor(line)
-            if p:
-                if isinstance(p, ElseProcessor) and count_if == 1:
-                    p.process(src, dest)
-                    return
-                else:
-                    if isinstance(p, IfdefProcessor) or isinstance(p, IfndefProcessor):
-                        count_if += 1
-                        if not export:
-                            dest.write(line)
-                    elif isinstance(p, EndifProcessor):
-                        count_if -= 1
-                        p.process(src, dest)
-                        if count_if == 0:
-                            return
-                    elif not export:
-                        dest.write(line)
-					
-            elif not export:
-                dest.write("%s %s" % (comment, line))
-            
-class IfndefProcessor(IfdefProcessor):
-	
     def __init__(self):
         self._tag = "#ifndef"
         self._tag_length = len(self._tag)
-	
-    def doExportProcess(self, src, dest):
-		
-        or_result = self.getExpressResult(src)
-        if not or_result:
-            self.recordIfBlockOnly(src, dest)
-        else:
-            self.recordElseBlockOnly(src, dest)
 
 class IncludeProcessor(TagProcessor):
     '''
 	# #include "file name"
     '''
-    def doExportProcess(self, src, dest):
+    def doExportProcess(self, src, dest, cm):
         express = src.next
         express_list = express.split(None, 2)
         if len(express_list) == 3:
             file_name = express_list[2].strip('"\r\n\t ')
-            include_full_path = os.path.join(ContextManager().src_base_dir,file_name)
+            if cm.src_base_dir is None:
+                raise Exception, "#include %s is not supported when preprocessing lines." % file_name
+            include_full_path = os.path.join(cm.src_base_dir,file_name)
             if not os.path.exists(include_full_path):
                 raise Exception, "%s does not exist." % include_full_path
 				
             dest.write(express)
-            include_dest = os.path.join(ContextManager().to_base_dir,file_name)
-            ContextManager().backupContext()
-            _processfile(include_full_path,include_dest)
-            ContextManager().restoreContext()
+            include_dest = os.path.join(cm.to_base_dir,file_name)
+            cm.recordInclude(include_full_path)
+            cm.backupContext()
+            _includefile(cm, include_full_path, include_dest)
+            cm.restoreContext()
 
-    def doNonExportProcess(self,src,dest):
-        self.doExportProcess(src,dest)
+    def doNonExportProcess(self, src, dest, cm):
+        self.doExportProcess(src, dest, cm)
 		
 class OutputProcessor(TagProcessor):
     '''
 	Translate   # #<< key
     into        # #<< key == value
     '''
-    def doExportProcess(self, src, dest):
+    def doExportProcess(self, src, dest, cm):
         line = src.next
         express_list = line.split()
         if len(express_list) == 3:
-            value = ContextManager().getDefineValue(express_list[2])
-            dest.write("%s == %s\r\n" % (line.rstrip("\r\n\t ") , str(value)))
+            value = cm.getDefineValue(express_list[2])
+            dest.write("%s == %s%s" % (line.rstrip("\r\n\t ") , str(value), _lineend(line)))
 
-    def doNonExportProcess(self, src, dest):
-        self.doExportProcess(src, dest)
+    def doNonExportProcess(self, src, dest, cm):
+        self.doExportProcess(src, dest, cm)
 		
 class OutputGlobalProcessor(OutputProcessor):
     '''
 	Translate   # #<< global key
 	into        # #<< global key == value
     '''
-    def doExportProcess(self, src, dest):
+    def doExportProcess(self, src, dest, cm):
         line = src.next
         express_list = line.split()
         if len(express_list) == 4:
             key = express_list[3]
-            value = ContextManager().getGlobalDefine(key)
-            dest.write("%s == %s\r\n" % (line.rstrip("\r\n\t ") , str(value)))
+            value = cm.getGlobalDefine(key)
+            dest.write("%s == %s%s" % (line.rstrip("\r\n\t ") , str(value), _lineend(line)))
 	
+def _lineend(line):
+    # the line end of line as it is in its file, none on the last line
+    return line[len(line.rstrip("\r\n")):]
+
 class UnknownProcessor(TagProcessor):
     '''
 	Do nothing
@@ -951,69 +1727,156 @@ class TagSelector(object):
                                 IncludeProcessor(),
                                 UnknownProcessor()	
 							)
-    __compile_list = None
+    __unknown = _LazyRegex(".+\\s*$")
 	
-    @classmethod
-    def setComment(cls,comment):
-		
-        __str_pattern_tuple = (
+    def __init__(self,comment,binary_sniff=BINARY_SNIFF):
+        """
+        A tag line is the comment mark followed by '#' and a keyword.
+        Only the keyword's own pattern is tried against a line.
+        A file with a NUL byte in its first binary_sniff bytes is binary.
+        """
+        self.__comment = comment
+        self.__binary_sniff = binary_sniff
+        name = "[A-Za-z_]\\w*"
+        bool_value = "(?:true|True|TRUE|false|False|FALSE)"
+        output_tail = "(?:\\s*$|\\s+==\\s+.+$)"
+
+        # #ifdef and #ifndef accept one or more comment marks,
+        # the first line of a UTF-8 file may start with its BOM
+        head = "\\s*" + comment + "+\\s*#"
+        strict_head = "\\s*" + comment + "\\s*#"
+        self.__head = _LazyRegex(head + "|" + codecs.BOM_UTF8 + head)
+        self.__strict_head = _LazyRegex(strict_head + "|" + codecs.BOM_UTF8 + strict_head)
+        # what every tag line has, searched for in a whole file. A match
+        # only starts at the first of a run of comment marks, else a long
+        # run would be tried again from each of its characters. The check
+        # comes after the first character, which the search looks for fast
+        first = re.escape(comment[:1])
+        rest = comment[1:] + "+" if len(comment) > 1 else first + "*"
+        self.__marker = _LazyRegex(first + "(?<!" + first + first + ")" + rest + "[^\\S\\n]*#")
+
+        define_pattern = "define\\s+(?:" + "|".join((
                     # #define bool true
-                    "^\\s*" + comment + "\\s*#define\\s+[A-Za-z_]+\\w*\\s+((true)|(True)|(TRUE)|(false)|(False)|(FALSE)){1}\\s*$",
+                    name + "\\s+" + bool_value + "\\s*$(?P<t0>)",
                     # #define int 123
-                    "^\\s*" + comment + "\\s*#define\\s+[A-Za-z_]+\\w*\\s+[+-]?\\d+\\s*$",
+                    name + "\\s+[+-]?\\d+\\s*$(?P<t1>)",
                     # #define float 123.4
-                    "^\\s*" + comment + "\\s*#define\\s+[A-Za-z_]+\\w*\\s+[+-]?\\d+(\\.?\\d+){1}\\s*$",
+                    name + "\\s+[+-]?\\d(?:\\d*\\.\\d+|\\d+)\\s*$(?P<t2>)",
                     # #define str "hello world"
-                    "^\\s*" + comment + "\\s*#define\\s+[A-Za-z_]+\\w*\\s+\".+\"\\s*$",
-					
+                    name + "\\s+\".+\"\\s*$(?P<t3>)",
+
                     # #define global bool true
-                    "^\\s*" + comment + "\\s*#define\\s+global\\s+[A-Za-z_]+\\w*\\s+((true)|(True)|(TRUE)|(false)|(False)|(FALSE)){1}\\s*$",
+                    "global\\s+" + name + "\\s+" + bool_value + "\\s*$(?P<t4>)",
                     # #define global int 123
-                    "^\\s*" + comment + "\\s*#define\\s+global\\s+[A-Za-z_]+\\w*\\s+[+-]?\\d+\\s*$",
+                    "global\\s+" + name + "\\s+[+-]?\\d+\\s*$(?P<t5>)",
                     # #define global float 123.4
-                    "^\\s*" + comment + "\\s*#define\\s+global\\s+[A-Za-z_]+\\w*\\s+[+-]?\\d+(\\.?\\d+){1}\\s*$",
+                    "global\\s+" + name + "\\s+[+-]?\\d(?:\\d*\\.\\d+|\\d+)\\s*$(?P<t6>)",
                     # #define global str "hello world"
-                    "^\\s*" + comment + "\\s*#define\\s+global\\s+[A-Za-z_]+\\w*\\s+\".+\"\\s*$",
-					
+                    "global\\s+" + name + "\\s+\".+\"\\s*$(?P<t7>)",
+                    )) + ")"
+
+        # (keyword, pattern after the '#', head used)
+        __keyword_tuple = (
+                    ("define", define_pattern, True),
                     # #ifdef
-                    "^\\s*" + comment + "+\\s*#ifdef\\s+.+$",
+                    ("ifdef", "ifdef\\s+.+$(?P<t8>)", False),
                     # #ifndef
-                    "^\\s*" + comment + "+\\s*#ifndef\\s+.+$", 
-
+                    ("ifndef", "ifndef\\s+.+$(?P<t9>)", False),
                     # #else
-                    "^\\s*" + comment + "\\s*#else\\s*$",
+                    ("else", "else\\s*$(?P<t10>)", True),
                     # #endif
-                    "^\\s*" + comment + "\\s*#endif\\s*$",
-                    
-                    # #<< param 
+                    ("endif", "endif\\s*$(?P<t11>)", True),
+                    # #<< param
                     # OR
                     # #<< param == value
-                    "^\\s*" + comment + "\\s*#<<\\s+[A-Za-z_]+\\w*\\s*(\\s+==\\s+.+){0,1}$",
                     # #<< global param
                     # OR
                     # #<< global param == value
-                    "^\\s*" + comment + "\\s*#<<\\s+global\\s+[A-Za-z_]+\\w*\\s*(\\s+==\\s+.+){0,1}$",
+                    ("<<", "<<\\s+(?:" + name + output_tail + "(?P<t12>)|global\\s+" + name + output_tail + "(?P<t13>))", True),
                     # #include "file"
-                    "^\\s*" + comment + "\\s*#include\\s+\".+\"\\s*$",
-                    # #whatever else
-                    "^\\s*" + comment + "\\s*#.+\\s*$"
+                    ("include", "include\\s+\".+\"\\s*$(?P<t14>)", True),
                     )
-				
-        cls.__compile_list = map(lambda x: re.compile(x),__str_pattern_tuple)
-			
-    @classmethod
-    def getTagProcessor(cls, sample):
 
-        for index,c in enumerate(cls.__compile_list):
-            sample = sample.rstrip("\r\n\t ")
-            if c.match(sample):
-                #print " %s ========>> match" % sample
-                return cls.__tag_processors_tuple[index]
+        self.__keyword_matchers = map(lambda x: (x[0], _LazyRegex(x[1]), x[2]), __keyword_tuple)
+
+    @property
+    def comment(self):
+        return self.__comment
+
+    @property
+    def binary_sniff(self):
+        return self.__binary_sniff
+
+    def getTagIndex(self, p):
+        return self.__tag_processors_tuple.index(p)
+
+    def getTagProcessorAt(self, index):
+        return self.__tag_processors_tuple[index]
+
+    def getTagProcessor(self, sample):
+
+        head = self.__head.match(sample)
+        if not head:
+            return None
+
+        sample = sample.rstrip("\r\n\t ")
+        strict_head = self.__strict_head.match(sample)
+        for keyword, c, strict in self.__keyword_matchers:
+            if strict:
+                if not strict_head:
+                    continue
+                start = strict_head.end()
+            else:
+                start = head.end()
+            if sample.startswith(keyword, start):
+                m = c.match(sample, start)
+                if m:
+                    #print " %s ========>> match" % sample
+                    return self.__tag_processors_tuple[int(m.lastgroup[1:])]
+
+        # #whatever else
+        if strict_head and self.__unknown.match(sample, strict_head.end()):
+            return self.__tag_processors_tuple[-1]
         return None
-	
+
+    def findTagLine(self, data, pos):
+        """
+        Return (start, tag processor) of the first tag line in data from
+        pos on, or (len(data), None) if there is none. pos is the start
+        of a line and data is a string or a mmap.
+        Only the lines with the comment mark followed by '#' are tried.
+        """
+        search = self.__marker.search
+        size = len(data)
+        while True:
+            m = search(data, pos)
+            if not m:
+                return size, None
+            i = m.start()
+            start = data.rfind("\n", pos, i) + 1 or pos
+            pos = data.find("\n", i) + 1 or size
+            p = self.getTagProcessor(data[start:pos])
+            if p:
+                return start, p
 		
+    def hasTagLine(self, data):
+        """
+        Return True if data, a string or a mmap, has a tag line. A file
+        without any is its own output, in every mode.
+        """
+        return data.find("#") >= 0 and self.findTagLine(data, 0)[1] is not None
+
+    def isBinary(self, data):
+        """
+        Return True if data, a string or a mmap, is the start or the whole
+        content of a binary file. It has a NUL byte in its first bytes, as
+        the UTF-16 and UTF-32 text files have too. The UTF-8 and the other
+        byte encodings have none, they are processed as they are.
+        """
+        return data[:self.__binary_sniff].find("\0") >= 0
+
     def showPatterns(self):
-        print self.__class__.__compile_list
+        print self.__keyword_matchers
 
 #############################################################
 #
@@ -1021,6 +1884,10 @@ class TagSelector(object):
 #
 #############################################################
 
+# the most entries the caches of the expresses and of the conditions keep,
+# each one is emptied when full, so --watch does not grow them for ever
+_cache_limit = 4096
+
 class ExpressSelector(object):
 
     """This is a express selector. It can return a express processor with a sample string"""
@@ -1043,20 +1910,830 @@ class ExpressSelector(object):
                             "(global\\s+)?[A-Za-z_]+\\w*$",
                         )
 								
-    __compile_list = map(lambda x: re.compile(x),__str_pattern_tuple)
+    __compile_list = map(_LazyRegex, __str_pattern_tuple)
+    __processor_cache = {}
 			
     @classmethod
     def getExpressProcessor(cls, sample):
 
+        try:
+            return cls.__processor_cache[sample]
+        except KeyError:
+            pass
+
+        processor = None
         for index,c in enumerate(cls.__compile_list):
             if c.match(sample):
                 #print " %s ========>> match" % sample.rstrip("\r\n\t ")
-                return cls.__express_processors_tuple[index]
-        return None
+                processor = cls.__express_processors_tuple[index]
+                break
+        cache = cls.__processor_cache
+        if len(cache) >= _cache_limit:
+            cache.clear()
+        cache[sample] = processor
+        return processor
 	
     def showPatterns(self):
         print self.__class__.__compile_list
 
+#############################################################
+#
+# Define compiled condition
+#
+#############################################################
+
+class Condition(object):
+
+    """
+    The condition of # #ifdef or # #ifndef, such as
+        a == 1 and global b or c != "str"
+    It is split into its express parsers only once for all the files.
+    The result is kept for each snapshot of the defines it refers to.
+    Both caches hold at most _cache_limit entries.
+    """
+    __cache = {}
+    __compile_name = _LazyRegex(r"^[A-Za-z_]\w*$")
+
+    def __init__(self, condition):
+        self.__condition = condition
+        or_list = []
+        keys = []
+        for and_express in condition.split(" or "):
+            and_list = []
+            for express in and_express.split(" and "):
+                express = express.strip("\r\n\t ")
+                parser = ExpressSelector.getExpressProcessor(express)
+                and_list.append((parser, express))
+                if parser:
+                    for key in self.__keysOf(parser, express):
+                        if key not in keys:
+                            keys.append(key)
+            or_list.append(tuple(and_list))
+        self.__or_list = tuple(or_list)
+        self.__keys = tuple(keys)
+        self.__results = {}
+
+    def __keysOf(self, parser, express):
+        '''
+        Return the (key, is global) the express reads: its left side, and
+        its right side for a ValueParser. The other right sides, "global"
+        and the operators are not defines.
+        '''
+        tokens = express.split()
+        keys = []
+        if len(tokens) > 1 and tokens[0] == "global":
+            keys.append((tokens[1], True))
+        else:
+            keys.append((tokens[0], False))
+        if isinstance(parser, ValueParser):
+            # "key == global key2" reads key2 as key, see ValueParser
+            keys.append((tokens[-1], len(tokens) == 5))
+        return [key for key in keys if self.__compile_name.match(key[0])]
+
+    @classmethod
+    def compile(cls, condition):
+        cache = cls.__cache
+        try:
+            return cache[condition]
+        except KeyError:
+            if len(cache) >= _cache_limit:
+                cache.clear()
+            c = cache[condition] = cls(condition)
+            return c
+
+    def __call__(self, cm):
+        snapshot = cm.getDefineSnapshot(self.__keys)
+        try:
+            result = self.__results[snapshot]
+            hit = True
+        except KeyError:
+            if len(self.__results) >= _cache_limit:
+                self.__results.clear()
+            result = self.__results[snapshot] = self.evaluate(cm)
+            hit = False
+        if cm.stats:
+            cm.stats.countCondition(self.__condition, hit)
+        return result
+
+    def evaluate(self, cm):
+        for and_list in self.__or_list:
+            for parser, express in and_list:
+                if not parser:
+                    raise SyntaxError, " %s is a illegale express" % express
+                if not parser.processExpress(express, cm):
+                    break # jump out and loop
+            else:
+                return True
+        return False
+
+#############################################################
+#
+# Define block tree
+#
+#############################################################
+
+# the kind of a block tag line, by the type of its processor
+_IFDEF, _ELSE, _ENDIF = range(1, 4)
+_block_kinds = {
+                    IfdefProcessor : _IFDEF,
+                    IfndefProcessor : _IFDEF,
+                    ElseProcessor : _ELSE,
+                    EndifProcessor : _ENDIF,
+                }
+
+class _TagLine(object):
+
+    """The src of a tag processor called for one tag line of a BlockTree"""
+    __slots__ = ('next',)
+    def __init__(self, line):
+        self.next = line
+
+class BlockTree(object):
+
+    """
+    A file parsed once: the runs of plain lines as (start, end) in the
+    content, the other tag lines with their processor, and the #ifdef
+    blocks as a tree with their conditions. render() makes the output for
+    the defines of a context by walking the tree, it processes the blocks
+    itself and calls the processors for the other tag lines. The nesting
+    costs neither stack frames nor more work per line.
+
+        (TEXT, start, end)
+        (TAG, line, index of the processor in the TagSelector)
+        [IF, line, is #ifndef, condition, nodes, #else line or None, nodes, #endif line]
+    """
+    __slots__ = ('nodes', 'lines', 'tags')
+    TEXT, TAG, IF = range(3)
+
+    def __init__(self, nodes, lines, tags):
+        self.nodes = nodes
+        self.lines = lines
+        # type name of the processor -> count
+        self.tags = tags
+
+    @classmethod
+    def parse(cls, data, checker, tag_selector):
+        '''
+        Parse data, a string or a mmap, checking its syntax with checker.
+        '''
+        tags = {}
+        it = FileIterator(data, tag_selector, checker)
+        nodes = list(cls.__parse(it, it.runSpan, tag_selector, tags))
+        return cls(nodes, checker.lines, tags)
+
+    @classmethod
+    def iterparse(cls, file, checker, tag_selector):
+        '''
+        Parse file, a file like object, as parse does, and yield (tree,
+        content) for each line out of a block and for each block once its
+        #endif is read, so the output can be made as the lines are read.
+        A plain line out of a block is its own output, its tree is None.
+        '''
+        it = FileIterator(file, tag_selector, checker)
+        text = cStringIO.StringIO()
+        def span():
+            start = text.tell()
+            text.write(it.next)
+            return start, text.tell()
+        TEXT = cls.TEXT
+        for node in cls.__parse(it, span, tag_selector, {}):
+            if node[0] == TEXT:
+                yield None, text.getvalue()
+            else:
+                yield cls([node], None, None), text.getvalue()
+            text.seek(0)
+            text.truncate()
+
+    @classmethod
+    def __parse(cls, it, span, tag_selector, tags):
+        '''
+        Yield the nodes of the lines of it out of a block, a block once its
+        #endif is read. span() skips the run of plain lines it is on and
+        returns its (start, end) in the content.
+        '''
+        # (block, the list it goes to) of the blocks open
+        stack = []
+        nodes = None
+        while it.hasMore:
+            p = it.processor
+            if not p:
+                start, end = span()
+                node = (cls.TEXT, start, end)
+            else:
+                line = it.next
+                name = type(p).__name__
+                tags[name] = tags.get(name, 0) + 1
+                kind = _block_kinds.get(type(p))
+                if kind == _IFDEF:
+                    condition = line[ line.find(p._tag) + p._tag_length: ].strip()
+                    block = [cls.IF, line, p.negate, condition, [], None, [], None]
+                    stack.append((block, nodes))
+                    nodes = block[4]
+                    continue
+                if kind == _ELSE:
+                    block = stack[-1][0]
+                    block[5] = line
+                    nodes = block[6]
+                    continue
+                if kind == _ENDIF:
+                    node, nodes = stack.pop()
+                    node[7] = line
+                else:
+                    node = (cls.TAG, line, tag_selector.getTagIndex(p))
+            if nodes is None:
+                yield node
+            else:
+                nodes.append(node)
+
+    # what render() does with a list of nodes, or with a line
+    __RENDER, __SKIP, __COMMENT, __WRITE, __MARK = range(5)
+
+    def render(self, data, dest, cm, marks=None):
+        '''
+        Write the output for the defines of cm to dest. With marks, a list,
+        the start and the end in dest of each run of lines commented out
+        are added to it, see BlockMap.
+
+        The nodes are walked with a stack of (what to do, iterator of nodes
+        or line): a block pushes the rest of its list back, then what comes
+        after its lines, then its lines, so the nesting is not limited.
+        '''
+        RENDER, SKIP, COMMENT, WRITE, MARK = self.__RENDER, self.__SKIP, self.__COMMENT, self.__WRITE, self.__MARK
+        TEXT, TAG = self.TEXT, self.TAG
+        export = cm.export
+        prefix = cm.comment + " "
+        tag_selector = cm.tag_selector
+        commented = self.__commented
+        stack = [(RENDER, iter(self.nodes))]
+        push = stack.append
+        while stack:
+            what, item = stack.pop()
+            if what == WRITE:
+                dest.write(item)
+            elif what == MARK:
+                commented(dest, item, marks)
+            elif what == RENDER:
+                for node in item:
+                    kind = node[0]
+                    if kind == TEXT:
+                        dest.write(data[node[1]:node[2]])
+                    elif kind == TAG:
+                        tag_selector.getTagProcessorAt(node[2]).process(_TagLine(node[1]), dest, cm)
+                    else:
+                        kind, line, negate, condition, if_nodes, else_line, else_nodes, endif_line = node
+                        if not export:
+                            dest.write(line)
+                        result = Condition.compile(condition)(cm)
+                        if negate:
+                            result = not result
+                        push((RENDER, item))
+                        if not export:
+                            push((WRITE, endif_line))
+                        if result:
+                            if not export and else_line is not None:
+                                push((COMMENT, iter(else_nodes)))
+                                push((WRITE, else_line))
+                            push((RENDER, iter(if_nodes)))
+                        else:
+                            if else_line is not None:
+                                push((RENDER, iter(else_nodes)))
+                                if not export:
+                                    push((WRITE, else_line))
+                            if not export:
+                                push((SKIP, iter(if_nodes)))
+                        break
+            elif what == SKIP:
+                # a block left out, the plain lines commented and the tag lines as they are
+                for node in item:
+                    kind = node[0]
+                    if kind == TEXT:
+                        commented(dest, _commentlines(data[node[1]:node[2]], prefix), marks)
+                    elif kind == TAG:
+                        dest.write(node[1])
+                    else:
+                        dest.write(node[1])
+                        push((SKIP, item))
+                        push((WRITE, node[7]))
+                        if node[5] is not None:
+                            push((SKIP, iter(node[6])))
+                            push((WRITE, node[5]))
+                        push((SKIP, iter(node[4])))
+                        break
+            else:
+                # an #else block left out, every line commented, and the
+                # #endif of a nested block once more as it is before
+                for node in item:
+                    kind = node[0]
+                    if kind == TEXT:
+                        commented(dest, _commentlines(data[node[1]:node[2]], prefix), marks)
+                    elif kind == TAG:
+                        commented(dest, prefix + node[1], marks)
+                    else:
+                        commented(dest, prefix + node[1], marks)
+                        push((COMMENT, item))
+                        push((MARK, prefix + node[7]))
+                        push((WRITE, node[7]))
+                        if node[5] is not None:
+                            push((COMMENT, iter(node[6])))
+                            push((MARK, prefix + node[5]))
+                        push((COMMENT, iter(node[4])))
+                        break
+
+    def __commented(self, dest, text, marks):
+        if marks is None:
+            dest.write(text)
+            return
+        start = dest.tell()
+        dest.write(text)
+        if marks and marks[-1] == start:
+            marks[-1] = dest.tell()
+        else:
+            marks.extend((start, dest.tell()))
+
+def _commentlines(text, prefix):
+    out = prefix + text.replace("\n", "\n" + prefix)
+    if text.endswith("\n"):
+        return out[:-len(prefix)]
+    return out
+
+class BlockTreeCache(object):
+
+    """
+    The block trees of the files by the md5 of the comment mark and the
+    content. They are kept for the run, and with a dir, as one pickle for
+    each tree, so a file is parsed again only when it changes.
+    The global defines an init file makes and its output are kept the
+    same way, see definesKey.
+    """
+
+    __version = 1
+
+    def __init__(self, path=None):
+        self.__path = path
+        self.__trees = {}
+        self.__defines = {}
+        # (srcfile, size, mtime, comment, content, key) of the last file read
+        self.__source = None
+
+    def read(self, srcfile, st, comment, tag_selector):
+        '''
+        Read srcfile, whose stat is st, and return (srcfile, size, mtime,
+        comment, content, key). The key is None for a file without tag
+        lines or a binary one, it needs no tree.
+        '''
+        data = _readsource(srcfile)
+        key = None
+        if not tag_selector.isBinary(data) and tag_selector.hasTagLine(data):
+            key = self.key(data, comment)
+        return (srcfile, st.st_size, st.st_mtime, comment, data, key)
+
+    def key(self, data, comment):
+        md5 = hashlib.md5(comment + "\0")
+        md5.update(data)
+        return md5.hexdigest()
+
+    def source(self, srcfile, comment, tag_selector):
+        '''
+        Return (content, key) of srcfile as read() does. The last file read
+        is kept when it is not mapped, so the variants of a build read and
+        hash it once.
+        '''
+        st = os.stat(srcfile)
+        last = self.__source
+        if last and last[:4] == (srcfile, st.st_size, st.st_mtime, comment):
+            return last[4], last[5]
+        source = self.read(srcfile, st, comment, tag_selector)
+        if isinstance(source[4], str):
+            self.__source = source
+        return source[4], source[5]
+
+    def keep(self, source):
+        '''
+        Keep source, (srcfile, size, mtime, comment, content, key) of a file
+        read ahead, for the next source() of the file.
+        '''
+        self.__source = source
+
+    def get(self, key):
+        tree = self.__trees.get(key)
+        if tree is None and self.__path:
+            nodes = self.__load(key)
+            if nodes is not None:
+                tree = self.__trees[key] = BlockTree(*nodes)
+        return tree
+
+    def put(self, key, tree):
+        self.__trees[key] = tree
+        if self.__path:
+            self.__save(key, (tree.nodes, tree.lines, tree.tags))
+
+    def definesKey(self, data, comment, export):
+        '''
+        Return the key of the global defines made by an init file whose
+        content is data, in the mode of export. It is another key than the
+        one of its tree.
+        '''
+        md5 = hashlib.md5("defines\0%s\0%d\0" % (comment, bool(export)))
+        md5.update(data)
+        return md5.hexdigest()
+
+    def getDefines(self, key):
+        '''
+        Return (global defines written, output) of an init file by its
+        definesKey, or None.
+        '''
+        defines = self.__defines.get(key)
+        if defines is None and self.__path:
+            defines = self.__load(key)
+            if defines is not None:
+                self.__defines[key] = defines
+        return defines
+
+    def putDefines(self, key, defines):
+        self.__defines[key] = defines
+        if self.__path:
+            self.__save(key, defines)
+
+    def __load(self, key):
+        try:
+            f = open(os.path.join(self.__path, key), "rb")
+            try:
+                version, content = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # not parsed yet, or a broken file, parse again
+            return None
+        if version != self.__version:
+            return None
+        return content
+
+    def __save(self, key, content):
+        if not os.path.isdir(self.__path):
+            os.makedirs(self.__path)
+        path = os.path.join(self.__path, key)
+        # the workers of -j may write the same tree, each one renames its own file
+        temp = "%s.%d" % (path, os.getpid())
+        f = open(temp, "wb")
+        try:
+            cPickle.dump((self.__version, content), f, cPickle.HIGHEST_PROTOCOL)
+        except RuntimeError:
+            # nested too deep for pickle, the tree is only kept for the run
+            f.close()
+            os.remove(temp)
+            return
+        finally:
+            f.close()
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # the tree is there already on Windows
+            os.remove(temp)
+
+#############################################################
+#
+# Define block map for reverse
+#
+#############################################################
+class BlockMap(object):
+
+    """
+    The runs of lines a comment mode run commented out in each output,
+    as (start, end) in the output, with the md5 of the output. -r uses
+    it to uncomment the runs of an output which was not changed since,
+    without parsing it again.
+
+    It gives back the lines the run commented out and nothing else, while
+    the scan of -r uncomments every plain line with the comment mark. So
+    the output of -r differs with and without the map for a plain line
+    which had the comment mark in its source already.
+    """
+
+    __version = 1
+
+    def __init__(self, path, comment):
+        self.__path = path
+        self.__root = os.path.dirname(os.path.realpath(path))
+        self.__comment = comment
+        self.__entries = {}
+
+    @classmethod
+    def find(cls, srcfile, comment):
+        '''
+        Return the block map of the dir of srcfile or of a dir above it, or None.
+        '''
+        path = os.path.realpath(srcfile)
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+        while True:
+            if os.path.isfile(os.path.join(path, BLOCKMAP_NAME)):
+                block_map = cls(os.path.join(path, BLOCKMAP_NAME), comment)
+                block_map.load()
+                return block_map
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def load(self):
+        try:
+            f = open(self.__path, "rb")
+            try:
+                version, comment, entries = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # no block map yet, or a broken one
+            return
+        if version == self.__version and comment == self.__comment:
+            self.__entries = entries
+
+    def save(self):
+        f = open(self.__path, "wb")
+        try:
+            cPickle.dump((self.__version, self.__comment, self.__entries), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def __key(self, tofile):
+        return os.path.relpath(os.path.realpath(tofile), self.__root)
+
+    def getEntry(self, tofile):
+        return self.__entries.get(self.__key(tofile))
+
+    def setEntry(self, tofile, entry):
+        if entry:
+            self.__entries[self.__key(tofile)] = entry
+
+    def removeEntry(self, tofile):
+        self.__entries.pop(self.__key(tofile), None)
+
+    def record(self, tofile, output, marks):
+        self.__entries[self.__key(tofile)] = (hashlib.md5(output).hexdigest(), tuple(marks))
+
+    def getMarks(self, srcfile, data):
+        '''
+        Return the runs commented out in data, the content of srcfile, or
+        None if srcfile has no entry or was changed since it was written.
+        '''
+        entry = self.__entries.get(self.__key(srcfile))
+        if not entry or hashlib.md5(data).hexdigest() != entry[0]:
+            return None
+        return entry[1]
+
+#############################################################
+#
+# Define path filter
+#
+#############################################################
+
+class PathFilter(object):
+
+    """
+    The files of a source dir to process, by the globs of --include and
+    --exclude and the ones in the .pypcignore file of the dir, one glob
+    per line, the blank lines and the lines starting with '#' left out.
+
+    A glob without '/' is matched with the name of each file and dir, one
+    with '/' with the path from the source dir, such as "lib/*.c". A glob
+    ending with '/' only matches dirs. An excluded dir is not entered.
+    With --include, only the files matching one of its globs are processed.
+    """
+
+    def __init__(self, srcdir=None, include=None, exclude=None):
+        exclude = list(exclude or ())
+        # the path of the ignore file, it is not a source
+        self.__ignore = None
+        if srcdir and os.path.isdir(srcdir):
+            ignore = self.__readIgnore(os.path.join(srcdir, IGNORE_NAME))
+            if ignore is not None:
+                exclude.extend(ignore)
+                self.__ignore = IGNORE_NAME
+        # (name matcher, path matcher) for the files and for the dirs
+        self.__include = self.__compile(include or (), False)
+        self.__exclude = self.__compile(exclude, False)
+        self.__exclude_dirs = self.__compile(exclude, True)
+        self.__empty = not (include or exclude or self.__ignore)
+
+    def __readIgnore(self, path):
+        try:
+            f = open(path, "r")
+        except IOError:
+            return None
+        try:
+            globs = []
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    globs.append(line)
+            return globs
+        finally:
+            f.close()
+
+    def __compile(self, globs, dirs):
+        names = []
+        paths = []
+        for glob in globs:
+            if glob.endswith("/"):
+                if not dirs:
+                    continue
+                glob = glob.rstrip("/")
+            if "/" in glob:
+                paths.append(fnmatch.translate(glob.lstrip("/")))
+            else:
+                names.append(fnmatch.translate(glob))
+        return tuple(re.compile("|".join("(?:%s)" % r for r in regex)).match if regex else None
+                     for regex in (names, paths))
+
+    def __matches(self, matchers, path, name):
+        name_match, path_match = matchers
+        return bool((name_match and name_match(name)) or (path_match and path_match(path)))
+
+    def excludes(self, path, name, isdir):
+        '''
+        Return True if the file or the dir at path, its path from the source
+        dir with '/' between the names, is left out.
+        '''
+        if self.__empty:
+            return False
+        if isdir:
+            return self.__matches(self.__exclude_dirs, path, name)
+        if path == self.__ignore or self.__matches(self.__exclude, path, name):
+            return True
+        include = self.__include
+        return bool(include[0] or include[1]) and not self.__matches(include, path, name)
+
+    def excludesDir(self, srcdir, dirpath):
+        '''
+        Return True if dirpath, a dir in srcdir, or one of the dirs it is in
+        is excluded.
+        '''
+        path = os.path.relpath(dirpath, srcdir)
+        if path == os.curdir:
+            return False
+        names = path.split(os.sep)
+        for i in range(len(names)):
+            if self.excludes("/".join(names[:i + 1]), names[i], True):
+                return True
+        return False
+
+#############################################################
+#
+# Define I/O pipeline
+#
+#############################################################
+class _Buffer(object):
+
+    """
+    A FIFO of items holding at most limit bytes. A larger item waits
+    until the buffer is empty, so it always gets in.
+    """
+
+    def __init__(self, limit):
+        self.__limit = limit
+        self.__items = collections.deque()
+        self.__size = 0
+        self.__cond = threading.Condition()
+
+    def put(self, item, size):
+        self.__cond.acquire()
+        try:
+            while self.__items and self.__size + size > self.__limit:
+                self.__cond.wait()
+            self.__items.append((item, size))
+            self.__size += size
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+    def get(self):
+        self.__cond.acquire()
+        try:
+            while not self.__items:
+                self.__cond.wait()
+            item, size = self.__items.popleft()
+            self.__size -= size
+            self.__cond.notifyAll()
+            return item
+        finally:
+            self.__cond.release()
+
+    def clear(self):
+        self.__cond.acquire()
+        try:
+            self.__items.clear()
+            self.__size = 0
+            self.__cond.notifyAll()
+        finally:
+            self.__cond.release()
+
+class IOPipeline(object):
+
+    """
+    Read the sources ahead and write the outputs behind the processing,
+    each in its own thread, so the waits on a slow or network file system
+    overlap with the work. Iterate it for (srcfile, tofile, source) in the
+    order of _walk, source is what the reader got for BlockTreeCache.keep,
+    or None when the file is left to the processing: a mapped file, one
+    done or up to date already, or one the reader failed on.
+    """
+
+    def __init__(self, cm, srcfile, limit):
+        self.__cm = cm
+        self.__srcfile = srcfile
+        self.__reads = _Buffer(limit)
+        self.__writes = _Buffer(limit)
+        self.__closed = False
+        self.__error = None
+        self.__reader = threading.Thread(target=self.__read)
+        self.__writer = threading.Thread(target=self.__write)
+        for thread in (self.__reader, self.__writer):
+            thread.daemon = True
+            thread.start()
+
+    def __iter__(self):
+        while True:
+            item = self.__reads.get()
+            if item is None:
+                return
+            srcfile, tofile, source = item
+            if srcfile is not None:
+                yield item
+            else:
+                # the walk failed, fail here as _preprocess would
+                raise source[0], source[1], source[2]
+
+    def __read(self):
+        try:
+            for srcfile, tofile in _walk(self.__srcfile, self.__cm.todir, self.__cm.path_filter):
+                if self.__closed:
+                    return
+                source = self.__readsource(srcfile)
+                self.__reads.put((srcfile, tofile, source), source and len(source[4]) or 0)
+        except Exception:
+            self.__reads.put((None, None, sys.exc_info()), 0)
+            return
+        self.__reads.put(None, 0)
+
+    def __readsource(self, srcfile):
+        cm = self.__cm
+        if cm.hasFileInDone(srcfile):
+            return None
+        try:
+            st = os.stat(srcfile)
+            if st.st_size >= _mmap_threshold:
+                return None
+            entry = cm.manifest and cm.manifest.getEntry(srcfile)
+            if entry and entry["src"][:2] == (st.st_size, st.st_mtime):
+                # most likely up to date, it is not read at all then
+                return None
+            source = cm.tree_cache.read(srcfile, st, cm.comment, cm.tag_selector)
+        except EnvironmentError:
+            return None
+        if not isinstance(source[4], str):
+            _closesource(source[4])
+            return None
+        return source
+
+    def write(self, tofile, output, srcfile=None, file_stats=None, link=False):
+        '''
+        Queue output for _saveoutput. The first failed write is raised here.
+        A mapped file is saved at once, it is closed after.
+        '''
+        if self.__error:
+            exc_info = self.__error
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if not isinstance(output, str):
+            _saveoutput(self.__cm, tofile, output, srcfile, file_stats, link)
+            return
+        self.__writes.put((tofile, output, srcfile, file_stats, link), len(output))
+
+    def __write(self):
+        while True:
+            item = self.__writes.get()
+            if item is None:
+                return
+            if self.__error:
+                continue
+            try:
+                _saveoutput(self.__cm, *item)
+            except Exception:
+                self.__error = sys.exc_info()
+
+    def close(self, failed=False):
+        '''
+        Stop reading and wait for the outputs queued so far. A failed write
+        is raised, unless the processing failed itself.
+        '''
+        self.__closed = True
+        self.__reads.clear()
+        self.__reader.join()
+        self.__writes.put(None, 0)
+        self.__writer.join()
+        if self.__error and not failed:
+            exc_info = self.__error
+            raise exc_info[0], exc_info[1], exc_info[2]
+
 #############################################################
 #
 # Define CheckSyntax
@@ -1071,37 +2748,51 @@ class SyntaxCheck(object):
                         EndifProcessor :"#endif" ,
                     }
     
-    def __init__(self, srcfile):
+    def __init__(self, srcfile, tag_selector):
         self.__srcfile = srcfile
-        self.__src = open(srcfile, "r")
+        self.__tag_selector = tag_selector
         self.__token_stack = []
+        self.__number_line = 0
 
     def check(self):
 		
+        data = _readsource(self.__srcfile)
         try:
-            it = FileIterator(self.__src)
-            self.__number_line = 0
+            it = FileIterator(data, self.__tag_selector, self)
             while it.hasMore:
-                self.__number_line += 1
-                self.__current_line = it.next
-                p = TagSelector.getTagProcessor(self.__current_line)
-                if p:
-                    if isinstance(p, UnknownProcessor):
-                        raise SyntaxError, self.__create_exception_string(" Expect one  #ifdef ,  #ifndef ,  #else  or  #endif ")
-                    else:
-                        token = self.__types_tokens.get(type(p),None)
-                        if token:
-                            self.__analyseToken(token)
-			
-            if self.__token_stack:
-                self.__number_line += 1
-                self.__current_line = "\r\n"
-                raise SyntaxError, self.__create_exception_string(" Expect #endif")
-
-            print "======>> syntax check done. src = %s" % self.__srcfile 
-            return True
+                if not it.processor:
+                    it.writeRun(None)
         finally:
-            self.__src.close()
+            _closesource(data)
+        print "======>> syntax check done. src = %s" % self.__srcfile 
+        return True
+
+    def checkLine(self, line, p):
+        """check one line, p is the tag processor of the line"""
+        self.__number_line += 1
+        self.__current_line = line
+        if p:
+            if isinstance(p, UnknownProcessor):
+                raise SyntaxError, self.__create_exception_string(" Expect one  #ifdef ,  #ifndef ,  #else  or  #endif ")
+            else:
+                token = self.__types_tokens.get(type(p),None)
+                if token:
+                    self.__analyseToken(token)
+
+    def skipLines(self, count):
+        """count plain lines which need no check"""
+        self.__number_line += count
+
+    @property
+    def lines(self):
+        return self.__number_line
+
+    def checkEnd(self):
+        """check the end of file, all the if blocks should be closed"""
+        if self.__token_stack:
+            self.__number_line += 1
+            self.__current_line = "\r\n"
+            raise SyntaxError, self.__create_exception_string(" Expect #endif")
 			
     def __analyseToken(self,token):
 		
@@ -1176,11 +2867,258 @@ class SyntaxCheck(object):
 
 #############################################################
 #
-# Define some methods for preprocessing
+# Define watcher
 #
 #############################################################
+class Watcher(object):
 
-def do_procedure(options):
+    """
+    Keep a tree preprocessed: build it once, then poll it and process again
+    the files changed and the files including them, each one with the
+    global defines it saw in the last full build.
+    The whole tree is built again when the global file changes, or a file
+    which has #define global changes, is added or removed, or when a build
+    failed half way. The output of a removed file is removed, with its
+    entries in the manifest, the dependency graph and the block map.
+    """
+
+    # seconds between two polls, pyinotify wakes up the poll sooner
+    interval = 0.1
+
+    def __init__(self, options):
+        self.__options = options
+        self.__manifest = _newmanifest(options)
+        self.__depends = _newdepends(options)
+        self.__tree_cache = BlockTreeCache(options.get("tree_cache"))
+        self.__block_map = _newblockmap(options)
+        self.__files = []       # (srcfile, tofile) in the order of processing
+        self.__sigs = {}        # srcfile -> (size, mtime)
+        self.__scans = {}       # srcfile -> (has #define global, included files)
+        self.__seen = {}        # srcfile -> global defines it saw
+        self.__base = {}        # the global defines of the global file
+        self.__global_sig = None
+        self.__pending = set()  # files which failed to be processed
+        self.__full = True
+        self.__scan_cm = ContextManager()
+        self.__scan_cm.set_options(options)
+        self.__notifier = None
+        if pyinotify:
+            manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+            path_filter = self.__scan_cm.path_filter
+            manager.add_watch(options["srcdir"], mask, rec=True, auto_add=True,
+                              exclude_filter=lambda path: path_filter.excludesDir(options["srcdir"], path))
+            manager.add_watch(os.path.dirname(options["global"]), mask)
+            self.__notifier = pyinotify.Notifier(manager, lambda event: None, timeout=self.interval * 1000)
+
+    def run(self):
+        """build and watch until Ctrl-C"""
+        print "======>> watching src = %s (Ctrl-C to stop)" % self.__options["srcdir"]
+        try:
+            while True:
+                self.poll()
+                self.__wait()
+        except KeyboardInterrupt:
+            print "======>> stop watching"
+
+    def poll(self):
+        """process what changed since the last poll, return the number of files processed"""
+        changed, removed, structure = self.__scanTree()
+        if removed:
+            self.__removeOutputs(removed)
+        if not self.__full and not changed and not structure and not self.__pending:
+            return 0
+
+        start = time.time()
+        if self.__full:
+            count = self.__build()
+        else:
+            affected = self.__affected(changed)
+            if structure and self.__hasDefineGlobal(self.__scans):
+                count = self.__build()
+            elif affected is None:
+                count = self.__build()
+            else:
+                count = self.__update(affected)
+        print "======>> %d file(s) processed in %.1f ms" % (count, (time.time() - start) * 1000)
+        return count
+
+    def __wait(self):
+        if self.__notifier:
+            if self.__notifier.check_events():
+                self.__notifier.read_events()
+                self.__notifier.process_events()
+        else:
+            time.sleep(self.interval)
+
+    def __scanTree(self):
+        '''
+        Stat the tree, return (changed files, (srcfile, tofile) of the removed
+        files, whether files were added or removed). The removed files are
+        not in changed, their includers are.
+        '''
+        options = self.__options
+        files = list(_walk(options["srcdir"], options["todir"], self.__scan_cm.path_filter))
+        sigs = {}
+        changed = set()
+        for srcfile, tofile in files:
+            try:
+                st = os.stat(srcfile)
+            except OSError:
+                continue
+            sigs[srcfile] = (st.st_size, st.st_mtime)
+            if self.__sigs.get(srcfile) != sigs[srcfile]:
+                changed.add(srcfile)
+        removed = set(self.__sigs) - set(sigs)
+        removed_files = [(srcfile, tofile) for srcfile, tofile in self.__files if srcfile in removed]
+        structure = bool(removed) or bool(set(sigs) - set(self.__sigs))
+
+        if os.path.exists(options["global"]):
+            st = os.stat(options["global"])
+            global_sig = (st.st_size, st.st_mtime)
+        else:
+            global_sig = None
+        if global_sig != self.__global_sig:
+            self.__full = True
+        self.__global_sig = global_sig
+
+        old_scans = self.__scans
+        scans = {}
+        for srcfile in sigs:
+            if srcfile in changed or srcfile not in old_scans:
+                try:
+                    scans[srcfile] = _scantags(self.__scan_cm, srcfile)
+                except EnvironmentError:
+                    scans[srcfile] = (False, [])
+            else:
+                scans[srcfile] = old_scans[srcfile]
+        for srcfile in removed:
+            # the files including a removed one are processed again
+            changed.update(f for f, (define_global, includes) in scans.iteritems() if srcfile in includes)
+            if old_scans.get(srcfile, (False, []))[0]:
+                self.__full = True
+        for srcfile in changed:
+            if old_scans.get(srcfile, (False, []))[0]:
+                self.__full = True
+
+        self.__files = files
+        self.__sigs = sigs
+        self.__scans = scans
+        return changed, removed_files, structure
+
+    def __removeOutputs(self, removed):
+        '''
+        Remove the outputs of the removed files and their entries.
+        '''
+        for srcfile, tofile in removed:
+            if os.path.isfile(tofile):
+                os.remove(tofile)
+                print "======>> removed dest = %s" % tofile
+            if self.__manifest:
+                self.__manifest.removeEntry(srcfile)
+            if self.__depends:
+                self.__depends.removeEntry(srcfile)
+            if self.__block_map and not self.__options["reverse"]:
+                self.__block_map.removeEntry(tofile)
+            self.__seen.pop(srcfile, None)
+            self.__pending.discard(srcfile)
+
+    def __hasDefineGlobal(self, scans):
+        for define_global, includes in scans.itervalues():
+            if define_global:
+                return True
+        return False
+
+    def __affected(self, changed):
+        '''
+        Return the changed files, the pending ones and all the files including
+        them, or None if one of them has #define global.
+        '''
+        includers = {}
+        for srcfile, (define_global, includes) in self.__scans.iteritems():
+            for include in includes:
+                includers.setdefault(include, set()).add(srcfile)
+
+        affected = set()
+        todo = list(changed | self.__pending)
+        while todo:
+            srcfile = todo.pop()
+            if srcfile in affected:
+                continue
+            affected.add(srcfile)
+            todo.extend(includers.get(os.path.realpath(srcfile), ()))
+        for srcfile in affected:
+            if self.__scans.get(srcfile, (False, []))[0]:
+                return None
+        return affected
+
+    def __build(self):
+        options = self.__options
+        cm = _newcontext(options, self.__manifest, self.__depends, self.__tree_cache, self.__block_map)
+        self.__pending = set()
+        self.__full = True
+        count = 0
+        try:
+            _processglobal(cm, options)
+            self.__base = cm.getGlobalDefines()
+            self.__seen = {}
+            if options["reverse"] or not self.__hasDefineGlobal(self.__scans):
+                # every file sees the global defines of the global file
+                for srcfile, tofile in self.__files:
+                    self.__seen[srcfile] = self.__base
+                if options["reverse"]:
+                    _reverse(cm, options["srcdir"])
+                else:
+                    _preprocess(cm, options["srcdir"])
+            else:
+                for srcfile, tofile in self.__files:
+                    self.__seen[srcfile] = cm.getGlobalDefines()
+                    _processfile(cm, srcfile, tofile)
+            self.__full = False
+        except Exception, e:
+            print "======>> build failed, the tree is built again on the next change\r\n%s" % e
+        finally:
+            _closecontext(cm, options)
+        for srcfile, tofile in self.__files:
+            if cm.hasFileInDone(srcfile):
+                count += 1
+        return count
+
+    def __update(self, affected):
+        options = self.__options
+        cm = _newcontext(options, self.__manifest, self.__depends, self.__tree_cache, self.__block_map)
+        try:
+            for srcfile, tofile in self.__files:
+                if srcfile not in affected or cm.hasFileInDone(srcfile):
+                    continue
+                cm.setGlobalDefines(self.__seen.get(srcfile, self.__base))
+                if options["reverse"]:
+                    _reversefile(cm, srcfile, tofile)
+                else:
+                    _processfile(cm, srcfile, tofile)
+            self.__pending = set()
+        except Exception, e:
+            self.__pending = set(f for f in affected if not cm.hasFileInDone(f))
+            print "======>> %s\r\n======>> %d file(s) left, they are processed on the next change" % (e, len(self.__pending))
+        finally:
+            _closecontext(cm, options)
+        return len(affected) - len(self.__pending)
+
+#############################################################
+#
+# Define some methods for preprocessing
+#
+#############################################################
+
+MANIFEST_NAME = ".pypc_manifest"
+DEPENDS_NAME = ".pypc_depends"
+BLOCKMAP_NAME = ".pypc_blockmap"
+IGNORE_NAME = ".pypcignore"
+
+# what a run keeps for itself in the destination dir
+_SIDECARS = (MANIFEST_NAME, DEPENDS_NAME, BLOCKMAP_NAME)
+
+def do_procedure(options):
 	
     if not os.path.exists(options["srcdir"]):
         raise Exception, "%s does not exist." % options["srcdir"]
@@ -1188,152 +3126,903 @@ def do_procedure(options):
     if not os.path.exists(options["todir"]):
         os.mkdir(options["todir"])
 	
+    cm = _newcontext(options, _newmanifest(options), _newdepends(options), None, _newblockmap(options))
+    try:
+        _processglobal(cm, options)
+        if options["reverse"]:
+            _reverse(cm, options["srcdir"])
+        else:
+            _preprocess(cm, options["srcdir"])
+    finally:
+        _closecontext(cm, options)
+
+def do_variants(options):
+    '''
+    Preprocess the tree once for all the variants in options["variants"],
+    a list of (name, init file). Each variant has its own context and is
+    written to todir/name, each file is parsed once for all of them.
+    '''
+    if not os.path.exists(options["srcdir"]):
+        raise Exception, "%s does not exist." % options["srcdir"]
+    if options.get("reverse",False) or options.get("watch",False) or options.get("jobs",1) > 1:
+        raise Exception, "--variant does not work with -r, -j or --watch."
+
+    tree_cache = BlockTreeCache(options.get("tree_cache"))
+    variants = []
+    try:
+        for name, global_def in options["variants"]:
+            variant_options = dict(options)
+            variant_options["todir"] = os.path.join(options["todir"], name)
+            variant_options["global"] = global_def
+            if options.get("stats"):
+                root, ext = os.path.splitext(options["stats"])
+                variant_options["stats"] = "%s.%s%s" % (root, name, ext)
+            if not os.path.exists(variant_options["todir"]):
+                os.makedirs(variant_options["todir"])
+            cm = _newcontext(variant_options, _newmanifest(variant_options), _newdepends(variant_options), tree_cache,
+                             _newblockmap(variant_options))
+            variants.append((cm, variant_options))
+            print "======>> variant %s" % name
+            _processglobal(cm, variant_options)
+
+        first_todir = variants[0][1]["todir"]
+        for srcfile, tofile in _walk(options["srcdir"], first_todir, variants[0][0].path_filter):
+            path = os.path.relpath(tofile, first_todir)
+            for cm, variant_options in variants:
+                _processfile(cm, srcfile, os.path.join(variant_options["todir"], path))
+    finally:
+        for cm, variant_options in variants:
+            _closecontext(cm, variant_options)
+
+def do_watch(options):
+    '''
+    Preprocess the tree as do_procedure does, then keep it up to date until Ctrl-C.
+    '''
+    if not os.path.exists(options["srcdir"]):
+        raise Exception, "%s does not exist." % options["srcdir"]
+	
+    if not os.path.exists(options["todir"]):
+        os.mkdir(options["todir"])
+
+    Watcher(options).run()
+
+def _newmanifest(options):
+    if not options.get("incremental",False):
+        return None
+    signature = (options.get("export",False), options.get("comment","#"), options.get("binary_sniff",BINARY_SNIFF))
+    manifest = Manifest(os.path.join(options["todir"], MANIFEST_NAME), signature)
+    manifest.load()
+    return manifest
+
+def do_affected(options):
+    '''
+    Print the outputs to make again when the files or the global defines in
+    options["affected"] change, using the graph of the last run with --depends.
+    '''
+    graph = DependencyGraph(os.path.join(options["todir"], DEPENDS_NAME))
+    if not graph.load():
+        raise Exception, "%s has no dependency graph, run with --depends first." % options["todir"]
+    files = []
+    defines = []
+    for name in options["affected"]:
+        if os.path.exists(name) or os.sep in name:
+            files.append(name)
+        else:
+            defines.append(name)
+    for tofile in graph.affected(files, defines):
+        print tofile
+
+def _newdepends(options):
+    if not options.get("depends",False) or options.get("reverse",False):
+        return None
+    depends = DependencyGraph(os.path.join(options["todir"], DEPENDS_NAME))
+    depends.load()
+    return depends
+
+def _newblockmap(options):
+    comment = options.get("comment","#")
+    if options.get("reverse",False):
+        return BlockMap.find(options["srcdir"], comment)
+    if not options.get("block_map",False) or options.get("export",False):
+        return None
+    block_map = BlockMap(os.path.join(options["todir"], BLOCKMAP_NAME), comment)
+    block_map.load()
+    return block_map
+
+def _newcontext(options, manifest=None, depends=None, tree_cache=None, block_map=None):
     cm = ContextManager()
     cm.set_options(options)
-    TagSelector.setComment(options.get("comment","#"))
-	
+    cm.manifest = manifest
+    cm.depends = depends
+    cm.block_map = block_map
+    cm.tree_cache = tree_cache or BlockTreeCache(options.get("tree_cache"))
+    if options.get("stats"):
+        cm.stats = Stats()
+    return cm
+
+def _closecontext(cm, options):
+    if cm.manifest:
+        cm.manifest.save()
+    if cm.depends:
+        cm.depends.save()
+    if cm.block_map and not options.get("reverse",False):
+        cm.block_map.save()
+    if cm.stats:
+        cm.stats.save(options["stats"])
+
+def _processglobal(cm, options):
     #process global.def first
     global_def_fullpath = options["global"]
     print "======>> using global file = %s" % global_def_fullpath
     if os.path.exists(global_def_fullpath):
         filename = os.path.split(global_def_fullpath)[1]
-        _processfile(global_def_fullpath,os.path.join(options["todir"],filename))
+        _globalfile(cm, global_def_fullpath,os.path.join(options["todir"],filename))
     else:
         print "======>> fail to find global file = %s\r\n======>> skip it....going on" % global_def_fullpath
-        
-    if options["reverse"]:
-        _reverse(options["srcdir"])
-    else:
-        _preprocess(options["srcdir"])
+    # -D, over the global file
+    for key, value in options.get("defines", ()):
+        cm.addGlobalDefine(key, value)
+
+def _globalfile(cm, srcfile, tofile):
+    '''
+    Process the global file, or apply the global defines it made the last
+    time it had the same content and write the same output again, without
+    parsing it. They are kept by the tree cache, only for a global file
+    without #include, in the runs keeping no manifest, graph, block map
+    nor statistics, which need the file processed.
+    '''
+    if cm.manifest or cm.depends or cm.block_map or cm.stats:
+        _processfile(cm, srcfile, tofile)
+        return
+
+    f = open(srcfile, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    cache = cm.tree_cache
+    key = cache.definesKey(data, cm.comment, cm.export)
+    defines = cache.getDefines(key)
+    if defines is not None:
+        writes, output = defines
+        for name, value in writes:
+            cm.addGlobalDefine(name, value)
+        _writeoutput(cm, tofile, output)
+        cm.addFileToDone(srcfile)
+        print '======>> cached. src = %s ' % srcfile
+        return
+
+    cm.beginRecord()
+    try:
+        _processfile(cm, srcfile, tofile)
+    finally:
+        record = cm.endRecord()
+    if not record.includes and len(record.outputs) == 1 and record.outputs[0][2] is not None:
+        cache.putDefines(key, (record.writes, record.outputs[0][2]))
+
+def preprocess_lines(lines, defines=None, export=False, comment="#", name="<lines>"):
+    '''
+    Preprocess lines in memory and yield the output lines.
+
+    lines is an iterable of lines which keep their line ends, or a file
+    like object. defines is a dict of global defines, name is the file
+    name used in the syntax errors. Nothing is read from or written to
+    the disk and the done list is not used, so #include is not supported.
+    The lines are read as the output is consumed.
+    '''
+    if not hasattr(lines, "readline"):
+        lines = LineReader(lines)
 
-def _reverse(srcfile):
-	
     cm = ContextManager()
-		
-    if os.path.isdir(srcfile):
-        for file in os.listdir(srcfile):
-            fullpath = os.path.realpath(os.path.join(srcfile,file))
-            #print fullpath
-            if os.path.isfile(fullpath):
-                _reverse(fullpath)
-            else:
-                old_dir = cm.todir
-                new_todir = os.path.join(old_dir, file)
-                #print new_todir
-                if not os.path.exists(new_todir):
-                    os.mkdir(new_todir)
-                cm.todir = new_todir
-                _reverse(fullpath)
-                cm.todir = old_dir
-    else:
+    cm.set_options({"export" : export, "comment" : comment})
+    cm.namespace_of_currentfile = name
+    for key, value in (defines or {}).iteritems():
+        cm.addGlobalDefine(key, value)
+
+    dest = LineWriter()
+    for tree, data in BlockTree.iterparse(lines, SyntaxCheck(name, cm.tag_selector), cm.tag_selector):
+        if tree is None:
+            yield data
+            continue
+        tree.render(data, dest, cm)
+        for line in dest.lines:
+            yield line
+        del dest.lines[:]
+
+_compile_define_name = _LazyRegex(r"[A-Za-z_]\w*$")
+_compile_define_integer = _LazyRegex(r"[+-]?\d+$")
+_compile_define_float = _LazyRegex(r"[+-]?\d*\.\d+$")
+
+def _definevalue(text):
+    '''
+    Return the value of -D KEY=text, typed as #define global types it.
+    The quotes of a string are optional.
+    '''
+    if text in ("true", "True", "TRUE"):
+        return True
+    if text in ("false", "False", "FALSE"):
+        return False
+    if _compile_define_integer.match(text):
+        return int(text)
+    if _compile_define_float.match(text):
+        return float(text)
+    if len(text) > 1 and text.startswith('"') and text.endswith('"'):
+        return text[1:-1]
+    return text
+
+def _walk(srcfile, todir, path_filter=None):
+    '''
+    Yield (srcfile, tofile) for all the files in srcfile, in the order
+    of processing. The destination dirs are not made here but with the
+    first file written in them, see _makedirs. The files and the dirs
+    path_filter excludes are left out, an excluded dir is not entered
+    at all, and so are the files a run keeps for itself, such as the
+    manifest, in every mode.
+    '''
+    if not os.path.isdir(srcfile):
         filename = os.path.basename(srcfile)
-        todir = os.path.join(cm.todir, filename)
+        yield srcfile, os.path.join(todir, filename)
+        return
+
+    # (entries, todir, path from srcfile) of the dirs being walked
+    stack = [(_listdir(os.path.realpath(srcfile)), todir, "")]
+    while stack:
+        entries, todir, base = stack[-1]
+        for name, fullpath, isdir in entries:
+            path = base + name
+            if not isdir and name in _SIDECARS:
+                continue
+            if path_filter and path_filter.excludes(path, name, isdir):
+                continue
+            if isdir:
+                stack.append((_listdir(fullpath), os.path.join(todir, name), path + "/"))
+                break
+            # a link to a file is named as the file
+            yield fullpath, os.path.join(todir, os.path.basename(fullpath))
+        else:
+            stack.pop()
+
+def _listdir(dirpath):
+    '''
+    Yield (name, full path, is a dir) for the entries of dirpath, a dir
+    without links in its path. Only the links are resolved, so the full
+    path is the real one as os.path.realpath would make it. Whatever is
+    not a dir is a file.
+    '''
+    if scandir:
+        for entry in scandir(dirpath):
+            if entry.is_symlink():
+                fullpath = os.path.realpath(entry.path)
+                yield entry.name, fullpath, os.path.isdir(fullpath)
+            else:
+                yield entry.name, entry.path, entry.is_dir()
+        return
+
+    for name in os.listdir(dirpath):
+        fullpath = os.path.join(dirpath, name)
+        mode = os.lstat(fullpath).st_mode
+        if stat.S_ISLNK(mode):
+            fullpath = os.path.realpath(fullpath)
+            yield name, fullpath, os.path.isdir(fullpath)
+        else:
+            yield name, fullpath, stat.S_ISDIR(mode)
+
+def _reverse(cm, srcfile):
+	
+    for srcfile, tofile in _walk(srcfile, cm.todir, cm.path_filter):
         #do reverse
-        _reversefile(srcfile, todir)
+        _reversefile(cm, srcfile, tofile)
 
-def _reversefile(srcfile, tofile):
+def _reversefile(cm, srcfile, tofile):
     
-    cm = ContextManager()
     if cm.hasFileInDone(srcfile):
         return
+
+    stats = cm.stats
+    if not stats:
+        _reversesource(cm, srcfile, tofile, None)
+        return
+    try:
+        _reversesource(cm, srcfile, tofile, stats.begin(srcfile))
+    finally:
+        stats.end()
+
+def _reversesource(cm, srcfile, tofile, file_stats):
 	
     print '======>> reversing src = %s dest = %s' % (srcfile, tofile)
-	
-    checker = SyntaxCheck(srcfile)
-    if not checker.check():
+
+    if _reversebinary(cm, srcfile, tofile, file_stats) or \
+       (cm.block_map and _reversemarks(cm, srcfile, tofile, file_stats)):
+        cm.addFileToDone(srcfile)
+        print '======>> done. src = %s ' % srcfile
         return
 	
+    checker = SyntaxCheck(srcfile, cm.tag_selector)
+    if not cm.one_pass:
+        if file_stats:
+            start = time.time()
+        if not checker.check():
+            return
+        if file_stats:
+            file_stats["check_seconds"] = time.time() - start
+        checker = None
+	
     cm.namespace_of_currentfile = srcfile
     comment = cm.comment
-    src = open(srcfile, "r")
-    dest = open(tofile, "w")
-    it = FileIterator(src)
-    while it.hasMore:
-        line = it.next
-        p = TagSelector.getTagProcessor(line)
-        if p:
-            dest.write(line)
-        else:
-            dest.write(line.replace(comment, "", 1))
+    src = open(srcfile, "rb")
+    dest = cStringIO.StringIO()
+    try:
+        it = FileIterator(src, cm.tag_selector, checker, file_stats)
+        while it.hasMore:
+            line = it.next
+            p = it.processor
+            if p:
+                dest.write(line)
+            else:
+                dest.write(line.replace(comment, "", 1))
+        if checker:
+            print "======>> syntax check done. src = %s" % srcfile 
+        written = _writefile(tofile, dest.getvalue())
+        if file_stats:
+            file_stats["unchanged"] = not written
+            file_stats["bytes_read"] = src.tell()
+            file_stats["bytes_written"] = dest.tell()
+    finally:
+        src.close()
+        dest.close()
         
     cm.addFileToDone(srcfile)
-    src.close()
-    dest.close()
     print '======>> done. src = %s ' % srcfile
 
-def _preprocess(srcfile):
+def _reversebinary(cm, srcfile, tofile, file_stats):
+    '''
+    Copy srcfile as it is when it is a binary file, only its first bytes
+    are read otherwise. Return False when it is not a binary file.
+    '''
+    f = open(srcfile, "rb")
+    try:
+        binary = cm.tag_selector.isBinary(f.read(cm.tag_selector.binary_sniff))
+    finally:
+        f.close()
+    if not binary:
+        return False
+    data = _readsource(srcfile)
+    try:
+        written = _writefile(tofile, data)
+        if file_stats:
+            file_stats["unchanged"] = not written
+            file_stats["bytes_read"] = len(data)
+            file_stats["bytes_written"] = len(data)
+    finally:
+        _closesource(data)
+    return True
+
+def _reversemarks(cm, srcfile, tofile, file_stats):
+    '''
+    Uncomment the runs of lines the block map has for srcfile, the other
+    lines are kept as they are, even with the comment mark, see BlockMap.
+    Return False when the map has nothing for srcfile as it is now.
+    '''
+    data = _readsource(srcfile)
+    try:
+        marks = cm.block_map.getMarks(srcfile, data)
+        if marks is None:
+            return False
+        comment = cm.comment
+        size = len(comment)
+        dest = cStringIO.StringIO()
+        pos = 0
+        for i in xrange(0, len(marks), 2):
+            start, end = marks[i], marks[i + 1]
+            dest.write(data[pos:start])
+            dest.write(data[start + size:end].replace("\n" + comment, "\n"))
+            pos = end
+        dest.write(data[pos:])
+        output = dest.getvalue()
+        written = _writefile(tofile, output)
+        if file_stats:
+            file_stats["unchanged"] = not written
+            file_stats["bytes_read"] = len(data)
+            file_stats["bytes_written"] = len(output)
+            file_stats["lines"] = output.count("\n") + (not output.endswith("\n") and len(output) > 0)
+    finally:
+        _closesource(data)
+    return True
+
+def _preprocess(cm, srcfile):
 	
-    cm = ContextManager()
-		
-    if os.path.isdir(srcfile):
-        for file in os.listdir(srcfile):
-            fullpath = os.path.realpath(os.path.join(srcfile,file))
-            #print fullpath
-            if os.path.isfile(fullpath):
-                _preprocess(fullpath)
-            else:
-                old_dir = cm.todir
-                new_todir = os.path.join(old_dir, file)
-                #print new_todir
-                if not os.path.exists(new_todir):
-                    os.mkdir(new_todir)
-                cm.todir = new_todir
-                _preprocess(fullpath)
-                cm.todir = old_dir
-    else:
-        filename = os.path.basename(srcfile)
-        todir = os.path.join(cm.todir, filename)
+    if cm.jobs > 1:
+        _preprocess_parallel(cm, srcfile, cm.jobs)
+        return
+
+    if cm.pipeline:
+        _preprocess_pipeline(cm, srcfile, cm.pipeline << 20)
+        return
+
+    for srcfile, tofile in _walk(srcfile, cm.todir, cm.path_filter):
         #do preprocess
-        _processfile(srcfile, todir)		
-        
+        _processfile(cm, srcfile, tofile)
+
+def _preprocess_parallel(cm, srcfile, jobs):
+    '''
+    A file which has no #include, no #define global and is not included
+    by another file only depends on the global defines. It is processed
+    in a worker with the global defines it would see in order.
+    The other files are processed here, in order, as _preprocess does.
+    The outputs of the workers are written here too, in order, so when a
+    file fails the pool is stopped and no file after it is written, as
+    without -j. Some files before it may not be written either.
+    '''
+    import multiprocessing
+    files = list(_walk(srcfile, cm.todir, cm.path_filter))
+    # the results waiting hold their outputs
+    max_pending = jobs * 4
+    pool = multiprocessing.Pool(jobs, _init_worker, (cm.options, cm.manifest, cm.depends, cm.block_map))
+    try:
+        in_order = set()
+        included = set()
+        for index, (define_global, includes) in enumerate(pool.map(_scanfile, [f[0] for f in files])):
+            if define_global or includes:
+                in_order.add(index)
+            included.update(includes)
+
+        pending = []
+        for index, (srcfile, tofile) in enumerate(files):
+            if index in in_order or os.path.realpath(srcfile) in included:
+                _processfile(cm, srcfile, tofile)
+            elif not cm.hasFileInDone(srcfile) and not _reusefile(cm, srcfile, tofile):
+                if len(pending) >= max_pending:
+                    _collect_worker(cm, *pending.pop(0))
+                pending.append((srcfile, tofile, pool.apply_async(_processfile_worker, (srcfile, tofile, cm.getGlobalDefines()))))
+                cm.addFileToDone(srcfile)
+            while pending and pending[0][2].ready():
+                _collect_worker(cm, *pending.pop(0))
+
+        for srcfile, tofile, result in pending:
+            _collect_worker(cm, srcfile, tofile, result)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+def _preprocess_pipeline(cm, srcfile, limit):
+    '''
+    Process the files in order as _preprocess does, while one thread reads
+    the next files and another one writes the outputs, with at most limit
+    bytes waiting on each side.
+    '''
+    pipeline = IOPipeline(cm, srcfile, limit)
+    cm.io_pipeline = pipeline
+    try:
+        for srcfile, tofile, source in pipeline:
+            if source:
+                cm.tree_cache.keep(source)
+            _processfile(cm, srcfile, tofile)
+    except:
+        cm.io_pipeline = None
+        pipeline.close(True)
+        raise
+    cm.io_pipeline = None
+    pipeline.close()
+
+# the context of a worker process, see _init_worker
+_worker_cm = None
+
+def _init_worker(options, manifest, depends, block_map):
+    global _worker_cm
+    _worker_cm = _newcontext(options, manifest, depends, None, block_map)
+
+def _scanfile(srcfile):
+    return _scantags(_worker_cm, srcfile)
+
+def _scantags(cm, srcfile):
+    '''
+    Return (has #define global, list of included files) for srcfile.
+    '''
+    define_global = False
+    includes = []
+    data = _readsource(srcfile)
+    try:
+        pos = len(data) if cm.tag_selector.isBinary(data) else 0
+        while True:
+            pos, p = cm.tag_selector.findTagLine(data, pos)
+            if not p:
+                break
+            end = data.find("\n", pos) + 1 or len(data)
+            if isinstance(p, DefineGlobalProcessor):
+                define_global = True
+            elif isinstance(p, IncludeProcessor):
+                express_list = data[pos:end].split(None, 2)
+                if len(express_list) == 3:
+                    file_name = express_list[2].strip('"\r\n\t ')
+                    includes.append(os.path.realpath(os.path.join(cm.src_base_dir,file_name)))
+            pos = end
+    finally:
+        _closesource(data)
+    return define_global, includes
+
+class _OutputList(object):
+
+    """
+    Keep the outputs a worker gives to _writeoutput, in place of the I/O
+    pipeline, for the main process to write them. The output of a mapped
+    file is None, the file is read there again.
+    """
+
+    def __init__(self):
+        self.items = []
+
+    def write(self, tofile, output, srcfile=None, file_stats=None, link=False):
+        if not isinstance(output, str):
+            output = None
+        self.items.append((tofile, output, srcfile, file_stats, link))
+
+def _processfile_worker(srcfile, tofile, global_defines):
+    '''
+    Process one file in a worker, return what it prints, its manifest entry,
+    its statistics, its dependency graph entry, its block map entry and its
+    outputs, which the main process writes.
+    '''
+    cm = _worker_cm
+    cm.setGlobalDefines(global_defines)
+    outputs = cm.io_pipeline = _OutputList()
+    stdout = sys.stdout
+    sys.stdout = out = cStringIO.StringIO()
+    try:
+        _processfile(cm, srcfile, tofile)
+    finally:
+        sys.stdout = stdout
+        cm.io_pipeline = None
+    return (out.getvalue(), cm.manifest and cm.manifest.getEntry(srcfile), cm.stats and cm.stats.takeFiles(),
+            cm.depends and cm.depends.getEntry(srcfile), cm.block_map and cm.block_map.getEntry(tofile),
+            outputs.items)
+
+def _collect_worker(cm, srcfile, tofile, result):
+    log, entry, stats, depends, block_map, outputs = result.get()
+    sys.stdout.write(log)
+    if entry:
+        cm.manifest.setEntry(srcfile, entry)
+    # the file_stats of an output are the ones of stats, which come in
+    # the same pickle
+    for output_tofile, output, output_srcfile, file_stats, link in outputs:
+        if output is None:
+            output = _readsource(output_srcfile)
+        try:
+            _saveoutput(cm, output_tofile, output, output_srcfile, file_stats, link)
+        finally:
+            _closesource(output)
+    if stats:
+        cm.stats.addFiles(*stats)
+    if depends:
+        cm.depends.setEntry(srcfile, depends)
+    if block_map:
+        cm.block_map.setEntry(tofile, block_map)
 		
 	
-def _processfile(srcfile, tofile):
+def _processfile(cm, srcfile, tofile):
 	
-    cm = ContextManager()
     if cm.hasFileInDone(srcfile):
         return
+    _makefile(cm, srcfile, tofile)
+
+def _includefile(cm, srcfile, tofile):
+    '''
+    Process srcfile for an #include. It is served from the include cache when
+    it was included before with the same content and the same values of the
+    global defines it reads, and processed again otherwise.
+    '''
+    cache = cm.include_cache
+    digest = cache.digest(srcfile)
+    entry = cache.lookup(cm, srcfile, tofile, digest)
+    if entry:
+        cache.replay(cm, entry)
+        if cm.stats:
+            cm.stats.countIncludeHit()
+        print '======>> cached. src = %s ' % srcfile
+        return
+
+    if cm.hasFileInDone(srcfile):
+        # done under other defines, the file starts again with no local define
+        cm.clearLocalDefines(srcfile)
+    cm.beginRecord()
+    try:
+        _makefile(cm, srcfile, tofile)
+    except Exception:
+        cm.endRecord()
+        raise
+    cache.add(cm, srcfile, tofile, digest, cm.endRecord())
+
+def _makefile(cm, srcfile, tofile):
+    if _reusefile(cm, srcfile, tofile):
+        return
+
+    stats = cm.stats
+    if not stats:
+        _processsource(cm, srcfile, tofile, None)
+        return
+    try:
+        _processsource(cm, srcfile, tofile, stats.begin(srcfile))
+    finally:
+        stats.end()
+
+def _processsource(cm, srcfile, tofile, file_stats):
 	
     print '======>> processing src = %s dest = %s' % (srcfile, tofile)
 	
-    checker = SyntaxCheck(srcfile)
-    if not checker.check():
-        return
-	
     cm.namespace_of_currentfile = srcfile
+
+    manifest = cm.manifest
+    depends = cm.depends
+    record = None
+    if manifest:
+        src_sig = _filesig(srcfile)
+    if manifest or depends:
+        cm.beginRecord()
 	
-    src = open(srcfile, "r")
-    dest = open(tofile, "w")
-    it = FileIterator(src)
-    while it.hasMore:
-        line = it.next
-        p = TagSelector.getTagProcessor(line)
-        if p:
-            p.process(it, dest)
+    block_map = cm.block_map
+    marks = None
+    if block_map:
+        marks = []
+    data, key = cm.tree_cache.source(srcfile, cm.comment, cm.tag_selector)
+    dest = cStringIO.StringIO()
+    try:
+        if key is None:
+            # no tag line, the content is copied as it is, a mapped file
+            # by chunks before it is closed
+            output = data
+            if file_stats:
+                file_stats["lines"] = _countlines(output)
         else:
-            dest.write(line)
+            _parsesource(cm, srcfile, data, key, file_stats).render(data, dest, cm, marks)
+            output = dest.getvalue()
+            if data[:3] == codecs.BOM_UTF8 and output[:3] != codecs.BOM_UTF8:
+                # the first line went out with the block it starts
+                output = codecs.BOM_UTF8 + output
+                if marks:
+                    marks[:] = [mark + 3 for mark in marks]
+        if manifest or depends:
+            record = cm.endRecord()
+        if cm.include_cache.checkOutput(srcfile, output):
+            if manifest:
+                manifest.record(srcfile, tofile, src_sig, output, record)
+            _writeoutput(cm, tofile, output, srcfile, file_stats, key is None and cm.link)
+            cm.recordOutput(srcfile, tofile, output if isinstance(output, str) else None)
+            if file_stats:
+                file_stats["bytes_written"] = len(output)
+            if block_map:
+                block_map.record(tofile, output, marks)
+        else:
+            print '======>> warning: %s is included under other defines than before, %s keeps its first output' \
+                  % (srcfile, tofile)
+            cm.recordOutput(srcfile, tofile, None)
+            if file_stats:
+                file_stats["unchanged"] = True
+                file_stats["bytes_written"] = 0
+        if file_stats:
+            file_stats["bytes_read"] = len(data)
+        if depends:
+            depends.record(srcfile, tofile, record)
+    except Exception:
+        if (manifest or depends) and not record:
+            cm.endRecord()
+        raise
+    finally:
+        _closesource(data)
+        dest.close()
     cm.addFileToDone(srcfile)
-    src.close()
-    dest.close()
     print '======>> done. src = %s ' % srcfile
 
+def _parsesource(cm, srcfile, data, key, file_stats):
+    '''
+    Return the block tree of the content of srcfile, from the tree cache
+    or parsed with its syntax checked, so each file is read only once.
+    '''
+    cache = cm.tree_cache
+    tree = cache.get(key)
+    if tree is None:
+        if file_stats:
+            start = time.time()
+        tree = BlockTree.parse(data, SyntaxCheck(srcfile, cm.tag_selector), cm.tag_selector)
+        print "======>> syntax check done. src = %s" % srcfile
+        if file_stats:
+            file_stats["check_seconds"] = time.time() - start
+        cache.put(key, tree)
+    if file_stats:
+        file_stats["lines"] = tree.lines
+        file_stats["tags"] = dict(tree.tags)
+    return tree
+
+def _reusefile(cm, srcfile, tofile):
+    '''
+    In incremental mode, skip srcfile if its output is up to date.
+    '''
+    if not cm.manifest:
+        return False
+    if cm.depends and not cm.depends.getEntry(srcfile):
+        # the graph has to learn about the file
+        return False
+    if not cm.manifest.reuse(cm, srcfile, tofile):
+        return False
+    cm.addFileToDone(srcfile)
+    if cm.stats:
+        cm.stats.countUpToDate()
+    print '======>> up to date. src = %s ' % srcfile
+    return True
+
+def _writeoutput(cm, tofile, output, srcfile=None, file_stats=None, link=False):
+    '''
+    Save output to tofile, by the writer thread of the I/O pipeline when
+    there is one, or by the main process for a worker, see _OutputList.
+    '''
+    if cm.io_pipeline:
+        cm.io_pipeline.write(tofile, output, srcfile, file_stats, link)
+        return
+    _saveoutput(cm, tofile, output, srcfile, file_stats, link)
+
+def _saveoutput(cm, tofile, output, srcfile, file_stats, link=False):
+    '''
+    Write output to tofile, or hard link srcfile as tofile when link is
+    set, then the manifest entry of srcfile takes the signature of tofile
+    and file_stats tells if it was left untouched.
+    '''
+    if link:
+        written = _linkfile(srcfile, tofile, output)
+    else:
+        written = _writefile(tofile, output)
+    if srcfile and cm.manifest:
+        cm.manifest.written(srcfile)
+    if file_stats:
+        file_stats["unchanged"] = not written
+
+def _writefile(tofile, output):
+    '''
+    The output is kept in memory until the whole file is done,
+    so nothing is written for a file with a syntax error. A mapped
+    file is written by chunks.
+    A file which has the output already is left untouched, so the build
+    tools after pypc do not see it changed, and False is returned.
+    Otherwise the output is written to a temporary file renamed over
+    tofile, so tofile is never seen half written.
+    '''
+    st = _statfile(tofile)
+    if st and _hasoutput(tofile, st, output):
+        return False
+    if not st:
+        _makedirs(os.path.dirname(tofile))
+
+    temp = "%s.pypc%d" % (tofile, os.getpid())
+    try:
+        dest = open(temp, "wb")
+        try:
+            if isinstance(output, str):
+                dest.write(output)
+            else:
+                for chunk in _chunks(output):
+                    dest.write(chunk)
+        finally:
+            dest.close()
+        if st:
+            os.chmod(temp, st.st_mode & 07777)
+        _replacefile(temp, tofile)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return True
+
+def _linkfile(srcfile, tofile, output):
+    '''
+    Hard link srcfile, whose content is output, as tofile. False is
+    returned when tofile is srcfile or holds output already, as _writefile
+    does. Where there are no hard links, the output is written instead.
+    '''
+    st = _statfile(tofile)
+    if st and (os.path.samestat(st, os.stat(srcfile)) or _hasoutput(tofile, st, output)):
+        return False
+    if not hasattr(os, "link"):
+        return _writefile(tofile, output)
+    if not st:
+        _makedirs(os.path.dirname(tofile))
+
+    temp = "%s.pypc%d" % (tofile, os.getpid())
+    try:
+        os.link(srcfile, temp)
+    except OSError:
+        # another device, or a file system without hard links
+        return _writefile(tofile, output)
+    try:
+        _replacefile(temp, tofile)
+    except:
+        os.remove(temp)
+        raise
+    return True
+
+def _makedirs(todir):
+    '''
+    Make todir and the dirs above it which do not exist, for the first
+    file written in it, so a dir without output is never made. Another
+    worker may make it at the same time.
+    '''
+    if os.path.isdir(todir):
+        return
+    try:
+        os.makedirs(todir)
+    except OSError:
+        if not os.path.isdir(todir):
+            raise
+
+def _statfile(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+def _hasoutput(path, st, output):
+    return st.st_size == len(output) and _samecontent(path, output)
+
+def _replacefile(temp, path):
+    try:
+        os.rename(temp, path)
+    except OSError:
+        # Windows does not rename over a file
+        os.remove(path)
+        os.rename(temp, path)
+
+def _samecontent(path, output):
+    '''
+    Return True if the file path holds output, read by chunks up to the
+    first difference.
+    '''
+    f = open(path, "rb")
+    try:
+        pos = 0
+        while True:
+            data = f.read(65536)
+            if not data:
+                return pos == len(output)
+            if output[pos:pos + len(data)] != data:
+                return False
+            pos += len(data)
+    finally:
+        f.close()
+
 def usage():
 	
     print """HELP for pypc:
-	python pypc.py -s srcfile [-d destdir [-e [-i initfile [-m comment ]]]]
+	python pypc.py -s srcfile [-d destdir [-e [-i initfile [-m comment ]]]] [-D key[=value] ...] [-j jobs] [--one-pass] [--incremental] [--stats file] [--watch] [--depends] [--tree-cache dir] [--block-map] [--pipeline MB] [--link] [--binary-sniff bytes] [--include glob] [--exclude glob]
+	python pypc.py -s srcfile -d destdir --variant name=initfile [--variant name=initfile ...] [-e] [-m comment] ...
+	python pypc.py -d destdir --affected file|define [--affected file|define ...]
 	-s source file/dir
 	-d destination dir. default is a dir named "done" which is in the same path with the source dir
 	-e flag to export, setting it is to export without all useless code blocks, otherwise, just to comment all useless code blocks
 	-i define a initfile, default is "global.def" which is in the same path with the source dir
 	-m define a character for comment, default is "#"
+	-D key[=value], define a global variable after the initfile, over its value there. true, false, numbers and strings, default is true
+	-j number of worker processes to preprocess the files of a dir, default is 1
+	--one-pass check the syntax while reversing, instead of reading each file twice
+	--incremental keep a manifest in the destination dir and skip the files which are up to date
+	--stats write the statistics of the run to a JSON file
+	--watch keep running and preprocess again the files which change, until Ctrl-C
+	--depends keep the dependency graph of the files in the destination dir
+	--tree-cache keep the parsed files in a dir, and parse a file again only when it changes
+	--link hard link the files without tag lines into the destination dir, instead of copying them
+	--binary-sniff the first bytes of a file looked at for a NUL, a binary file is copied as it is. default is 8000, 0 to process every file
+	--pipeline MB, read the next files and write the outputs in threads while processing, at most MB waiting each way
+	--block-map keep the lines commented out by each file in the destination dir, so -r can uncomment them without parsing
+	--variant name=initfile, preprocess the tree for each variant into destdir/name, parsing each file once
+	--include glob, only process the files of the source dir matching one of the globs, such as "*.c"
+	--exclude glob, leave out the files and the dirs matching one of the globs, such as ".git" or "build/", so do the globs in .pypcignore
+	--affected list the outputs to make again when a file or a global define changes, with the graph of -d
 """
 
 def main():
 	
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "s:d:rei:m:")
+        opts, args = getopt.getopt(sys.argv[1:], "s:d:rei:m:j:D:", ["one-pass", "incremental", "stats=", "watch", "depends", "affected=", "tree-cache=", "variant=", "block-map", "pipeline=", "link", "binary-sniff=", "include=", "exclude="])
 
-        if not opts or '-s' not in map(lambda x:x[0],opts):
+        names = map(lambda x:x[0],opts)
+        if not opts or ('-s' not in names and '--affected' not in names):
             usage()
             sys.exit(2)
 	
@@ -1385,8 +4074,86 @@ def main():
         
         elif opt == "-m":
             options["comment"] = arg
+
+        elif opt == "-D":
+            key, sep, value = arg.partition("=")
+            if not _compile_define_name.match(key):
+                usage()
+                sys.exit(2)
+            options.setdefault("defines", []).append((key, _definevalue(value) if sep else True))
+
+        elif opt == "-j":
+            try:
+                options["jobs"] = int(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
+
+        elif opt == "--one-pass":
+            options["one_pass"] = True
+
+        elif opt == "--incremental":
+            options["incremental"] = True
+
+        elif opt == "--stats":
+            if os.path.isabs(arg):
+                options["stats"] = arg
+            else:
+                options["stats"] = os.path.join(base_dir,arg)
+
+        elif opt == "--watch":
+            options["watch"] = True
+
+        elif opt == "--depends":
+            options["depends"] = True
+
+        elif opt == "--link":
+            options["link"] = True
+
+        elif opt == "--binary-sniff":
+            try:
+                options["binary_sniff"] = int(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
+
+        elif opt == "--pipeline":
+            try:
+                options["pipeline"] = int(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
+
+        elif opt == "--block-map":
+            options["block_map"] = True
+
+        elif opt == "--tree-cache":
+            options["tree_cache"] = os.path.abspath(arg)
+
+        elif opt == "--variant":
+            name, sep, global_def = arg.partition("=")
+            if not sep or not name or os.sep in name or name in (os.curdir, os.pardir):
+                usage()
+                sys.exit(2)
+            options.setdefault("variants", []).append((name, os.path.abspath(global_def)))
+
+        elif opt == "--affected":
+            options.setdefault("affected", []).append(arg)
+
+        elif opt == "--include":
+            options.setdefault("include", []).append(arg)
+
+        elif opt == "--exclude":
+            options.setdefault("exclude", []).append(arg)
 							
-    do_procedure(options)
+    if options.get("affected"):
+        do_affected(options)
+    elif options.get("variants"):
+        do_variants(options)
+    elif options.get("watch",False):
+        do_watch(options)
+    else:
+        do_procedure(options)
 
     return 0
 